@@ -0,0 +1,98 @@
+"""
+Кэш прав доступа: участник ли пользователь команды и админ ли он.
+
+Это две разные проверки: владелец бота (admin_id) — для команд
+управления, роль "admin" в записи участника — для search_task и
+task_done. Владелец не получает роль автоматически, а админ по роли —
+права владельца.
+
+Проверка членства — первое, что делает почти каждый хендлер, поэтому
+роль вычисляется один раз и держится в кэше по user_id. Записи
+сбрасываются, когда Store сообщает об изменении участника (сейчас —
+при перезагрузке), а TTL страхует от правок, о которых Store не знает.
+Отказы тоже кэшируются:
+поток сообщений от посторонних не доходит даже до Store, а отвечаем
+таким пользователям не чаще раза в deny_ttl секунд.
+"""
+import time
+
+MEMBER = "member"
+ADMIN = "admin"
+
+
+class AccessCache:
+    # Столько записей держим, прежде чем выкинуть устаревшие: поток
+    # сообщений от разных посторонних не должен раздувать кэш без конца
+    MAX_ENTRIES = 10000
+
+    def __init__(self, store, admin_id, ttl=300, deny_ttl=60):
+        self.store = store
+        self.admin_id = admin_id
+        self.ttl = ttl
+        self.deny_ttl = deny_ttl
+        # user_id -> (роль или None, до какого момента запись верна)
+        self._roles = {}
+        # user_id -> когда последний раз отвечали отказом
+        self._warned = {}
+        store.subscribe(self._on_change)
+
+    def _on_change(self, kind, entity_id):
+        if kind == "user":
+            self.invalidate(entity_id)
+
+    def invalidate(self, user_id=None):
+        """Сбрасывает запись участника, а без user_id — весь кэш."""
+        if user_id is None:
+            self._roles.clear()
+            self._warned.clear()
+        else:
+            self._roles.pop(user_id, None)
+            self._warned.pop(user_id, None)
+
+    def _resolve(self, user_id):
+        user = self.store.get_user(user_id)
+        if user is None:
+            return None
+        if "admin" in user.get("roles", []) or user.get("role") == "admin":
+            return ADMIN
+        return MEMBER
+
+    def role(self, user_id):
+        """ADMIN, MEMBER или None, если пользователь не в команде."""
+        now = time.monotonic()
+        cached = self._roles.get(user_id)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        role = self._resolve(user_id)
+        if len(self._roles) >= self.MAX_ENTRIES:
+            self._prune(now)
+        self._roles[user_id] = (role, now + self.ttl)
+        return role
+
+    def is_member(self, user_id):
+        return self.role(user_id) is not None
+
+    def is_admin(self, user_id):
+        """Есть ли у участника роль admin."""
+        return self.role(user_id) == ADMIN
+
+    def is_owner(self, user_id):
+        """Владелец ли это бота (admin_id)."""
+        return user_id == self.admin_id
+
+    def should_warn(self, user_id):
+        """True, если постороннему пора снова ответить отказом."""
+        now = time.monotonic()
+        last = self._warned.get(user_id)
+        if last is not None and now - last < self.deny_ttl:
+            return False
+        if len(self._warned) >= self.MAX_ENTRIES:
+            self._prune(now)
+        self._warned[user_id] = now
+        return True
+
+    def _prune(self, now):
+        self._roles = {uid: entry for uid, entry in self._roles.items() if entry[1] > now}
+        self._warned = {
+            uid: last for uid, last in self._warned.items() if now - last < self.deny_ttl
+        }
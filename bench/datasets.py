@@ -0,0 +1,102 @@
+"""
+Синтетические данные для бенчмарка: участники, задачи и события в том
+же формате, что users.json, tasks.json и events.json.
+
+Генерация детерминирована (seed), поэтому прогоны на одном размере
+сравнимы между собой. Примерно треть задач закреплена за участниками
+(не больше трёх на человека, с дедлайном и персональным событием),
+остальные свободны. Общие события разбросаны по ближайшему месяцу.
+"""
+import random
+from datetime import datetime, timedelta
+
+PROJECTS = ["Starky Jungle", "Ideal Abyss", "Unsouled", "Non-project work"]
+ROLES = [
+    "программирование", "геймдизайн", "сценарий и текст", "маркетинг и PR",
+    "менеджмент", "финансы", "документация", "визуальная работа", "музыка и аудио",
+]
+# Слова для названий и описаний, чтобы поиску было что индексировать
+WORDS = [
+    "механики", "уровня", "врагов", "интерфейса", "звука", "персонажа", "диалогов",
+    "анимации", "макета", "сцены", "инвентаря", "квеста", "трейлера", "бюджета",
+    "документации", "релиза", "тестирования", "оптимизации", "освещения", "карты",
+]
+FIRST_USER_ID = 1_000_000
+
+
+def _iso(moment):
+    return moment.replace(microsecond=0).isoformat()
+
+
+def _sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def generate(size, admin_id, now=None, seed=1):
+    """
+    Возвращает {"users": [...], "tasks": [...], "events": [...]}, по size
+    записей в каждой коллекции. Первый участник — админ с admin_id.
+    """
+    rng = random.Random(seed)
+    now = now or datetime.now()
+
+    users = []
+    for i in range(size):
+        user_id = admin_id if i == 0 else FIRST_USER_ID + i
+        points = {p: rng.choice((0, 0, rng.randint(1, 300))) for p in PROJECTS}
+        users.append({
+            "user_id": user_id,
+            "username": "StanPaige" if i == 0 else f"bench_user_{i}",
+            "full_name": f"Участник {i}",
+            "role": "admin" if i == 0 else "member",
+            "points": points,
+            "percent_rate": dict.fromkeys(PROJECTS, 0.0),
+            "reserved_tasks": [],
+            "roles": ROLES if i == 0 else rng.sample(ROLES, rng.randint(1, 3)),
+        })
+
+    tasks, events = [], []
+    for task_id in range(1, size + 1):
+        task = {
+            "id": task_id,
+            "project": rng.choice(PROJECTS),
+            "title": f"Создание {_sentence(rng, 3).lower()}",
+            "description": _sentence(rng, 12),
+            "type": rng.choice(ROLES),
+            "points": rng.randint(5, 50),
+            "estimated_days": rng.randint(1, 14),
+            "deadline": None,
+            "reserved_by": None,
+        }
+        owner = rng.choice(users)
+        if task_id % 3 == 0 and len(owner["reserved_tasks"]) < 3:
+            deadline = _iso(now + timedelta(days=task["estimated_days"], minutes=task_id))
+            task["deadline"] = deadline
+            task["reserved_by"] = owner["user_id"]
+            owner["reserved_tasks"].append(task_id)
+            events.append({
+                "id": len(events) + 1,
+                "type": "deadline",
+                "title": f"Дедлайн по задаче #{task_id}",
+                "description": "Пожалуйста, завершите работу в срок.",
+                "datetime": deadline,
+                "notify_users": True,
+                "personal": True,
+                "users": [owner["user_id"]],
+                "task_id": task_id,
+            })
+        tasks.append(task)
+
+    while len(events) < size:
+        events.append({
+            "id": len(events) + 1,
+            "type": "meeting",
+            "title": _sentence(rng, 3),
+            "description": _sentence(rng, 8),
+            "datetime": _iso(now + timedelta(minutes=rng.randint(60, 30 * 24 * 60))),
+            "notify_users": True,
+            "notified_24h": False,
+            "notified_2h": False,
+        })
+
+    return {"users": users, "tasks": tasks, "events": events}
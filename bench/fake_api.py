@@ -0,0 +1,334 @@
+"""
+Локальная замена Bot API для нагрузочных прогонов без сети.
+
+Сервер понимает то, чем пользуется бот: getMe, getUpdates (long polling
+с offset/timeout), sendMessage, editMessageText, setMyCommands и
+прочие методы, на которые достаточно ответить true. Бот направляется
+сюда через base_url:
+
+    python bench/fake_api.py --port 8081 --latency 0.05 --chat-rate 1 --global-rate 30
+    BOT_API_URL=http://127.0.0.1:8081/bot BOT_METRICS_PORT=0 python bot.py
+
+Поведение Telegram, которое важно для рассылок и напоминаний, задаётся
+флагами: задержка ответа (--latency, --jitter), лимиты как у настоящего
+flood control (--global-rate, --chat-rate — превышение даёт 429 с
+retry_after), случайные 429 (--retry-after-rate) и ошибки
+(--error-rate, 400 или 500 пополам). Лимиты и сбои касаются только
+отправки сообщений.
+
+Входящий трафик: --traffic N генерирует N апдейтов в секунду — команды
+(--commands) от участников из --users. Свои апдейты можно положить в
+очередь через POST /fake/updates (JSON-объект или массив объектов
+Update без update_id), а счётчики вызовов и ответов смотреть на
+GET /fake/stats.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter, deque
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger("fake_api")
+
+# Столько апдейтов getUpdates отдаёт за раз, если limit не указан
+UPDATES_LIMIT = 100
+# Сколько неподтверждённых апдейтов держать, прежде чем выбрасывать старые
+MAX_PENDING = 100_000
+DEFAULT_COMMANDS = ("/start", "/my_task", "/upcoming_events", "/my_points")
+# Сбои и лимиты касаются только отправки сообщений: getMe и
+# setMyCommands при старте должны проходить, как у настоящего Telegram
+SEND_METHODS = frozenset(("sendMessage", "editMessageText"))
+
+
+class RateLimit:
+    """Token bucket, который не ждёт, а говорит, через сколько секунд повторить."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def take(self) -> int:
+        """0, если запрос проходит, иначе retry_after в целых секундах."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return max(1, math.ceil((1 - self._tokens) / self.rate))
+
+
+class FakeBotApi:
+    def __init__(self, latency=0.0, jitter=0.0, global_rate=0.0, chat_rate=0.0,
+                 retry_after_rate=0.0, retry_after=1, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.chat_rate = chat_rate
+        self.global_limit = RateLimit(global_rate) if global_rate else None
+        self._chat_limits = {}
+        self.rng = random.Random(seed)
+        # Вызовы по методам и ответы по кодам — для /fake/stats
+        self.calls = Counter()
+        self.responses = Counter()
+        self.commands = []
+        self._updates = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+
+    # --- Входящие апдейты ---
+
+    def push_update(self, update: dict):
+        """Кладёт апдейт (без update_id) в очередь для getUpdates."""
+        if len(self._updates) >= MAX_PENDING:
+            self._updates.popleft()
+        self._updates.append({"update_id": next(self._update_ids), **update})
+        self._new_updates.set()
+
+    def push_message(self, user_id, text):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        self.push_update({"message": message})
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or UPDATES_LIMIT)
+        timeout = float(params.get("timeout") or 0)
+        # offset подтверждает всё, что меньше него
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, limit))
+
+    # --- Исходящие вызовы ---
+
+    def _flood_wait(self, method, params):
+        """retry_after, если запрос упирается в лимиты, иначе 0."""
+        if self.retry_after_rate and self.rng.random() < self.retry_after_rate:
+            return self.retry_after
+        if self.global_limit:
+            wait = self.global_limit.take()
+            if wait:
+                return wait
+        if self.chat_rate:
+            chat_id = params.get("chat_id")
+            limit = self._chat_limits.get(chat_id)
+            if limit is None:
+                limit = self._chat_limits[chat_id] = RateLimit(self.chat_rate, capacity=1)
+            return limit.take()
+        return 0
+
+    def _message(self, params):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"},
+            "text": params.get("text", ""),
+        }
+
+    async def call(self, method, params):
+        """Выполняет метод Bot API. Возвращает (HTTP-код, тело ответа)."""
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self.get_updates(params)}
+
+        delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        wait = self._flood_wait(method, params) if method in SEND_METHODS else 0
+        if wait:
+            return 429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {wait}",
+                "parameters": {"retry_after": wait},
+            }
+        if method in SEND_METHODS and self.error_rate and self.rng.random() < self.error_rate:
+            if self.rng.random() < 0.5:
+                return 400, {"ok": False, "error_code": 400,
+                             "description": "Bad Request: chat not found"}
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(params)
+        elif method == "setMyCommands":
+            self.commands = json.loads(params.get("commands") or "[]")
+            result = True
+        elif method == "getMyCommands":
+            result = self.commands
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+    def stats(self):
+        return {
+            "calls": dict(self.calls),
+            "responses": {str(code): n for code, n in self.responses.items()},
+            "pending_updates": len(self._updates),
+        }
+
+    # --- HTTP ---
+
+    async def _route(self, verb, path, body):
+        if path == "/fake/stats":
+            return 200, self.stats()
+        if path == "/fake/updates" and verb == "POST":
+            updates = json.loads(body or b"[]")
+            for update in updates if isinstance(updates, list) else [updates]:
+                self.push_update(update)
+            return 200, {"ok": True, "result": len(self._updates)}
+        # /bot<token>/<method>
+        parts = path.strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        return await self.call(parts[1], body)
+
+    async def _handle(self, reader, writer):
+        # Одно соединение — много запросов подряд (keep-alive у httpx)
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                raw = await reader.readexactly(length) if length else b""
+
+                verb, target = request.decode("latin-1").split()[:2]
+                path, _, query = target.partition("?")
+                if path.startswith("/fake/"):
+                    body = raw
+                else:
+                    body = _parse_params(headers.get("content-type", ""), raw, query)
+                code, payload = await self._route(verb, path, body)
+                self.responses[code] += 1
+
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                writer.write(
+                    f"HTTP/1.1 {code} {'OK' if code == 200 else 'Error'}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8081):
+        server = await asyncio.start_server(self._handle, host, port)
+        logger.info("🧪 Fake Bot API: http://%s:%s/bot", host, port)
+        return server
+
+
+def _parse_params(content_type, raw, query):
+    """
+    Параметры метода. PTB шлёт их формой, где строки как есть, а числа и
+    объекты — в JSON; multipart (файлы) не разбираем.
+    """
+    params = dict(parse_qsl(query))
+    if content_type.startswith("application/json") and raw:
+        params.update({k: v if isinstance(v, str) else json.dumps(v)
+                       for k, v in json.loads(raw).items()})
+    elif content_type.startswith("application/x-www-form-urlencoded"):
+        params.update(parse_qsl(raw.decode()))
+    return params
+
+
+async def generate_traffic(api, user_ids, commands, rate):
+    """rate апдейтов в секунду: случайная команда от случайного участника."""
+    rng = random.Random()
+    interval = 1 / rate
+    while True:
+        api.push_message(rng.choice(user_ids), rng.choice(commands))
+        await asyncio.sleep(interval)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument("--global-rate", type=float, default=0.0,
+                        help="sendMessage в секунду на бота (0 — без лимита; в Telegram ~30)")
+    parser.add_argument("--chat-rate", type=float, default=0.0,
+                        help="sendMessage в секунду в один чат (0 — без лимита; в Telegram ~1)")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0,
+                        help="доля запросов, на которые сразу отвечать 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after для случайных 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 400/500")
+    parser.add_argument("--users", help="users.json, из которого брать отправителей для --traffic")
+    parser.add_argument("--traffic", type=float, default=0.0, help="входящих апдейтов в секунду")
+    parser.add_argument("--commands", default=",".join(DEFAULT_COMMANDS),
+                        help="команды для --traffic через запятую")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+    if args.traffic and not args.users:
+        parser.error("для --traffic нужен --users")
+    return args
+
+
+async def run(args):
+    api = FakeBotApi(
+        latency=args.latency, jitter=args.jitter, global_rate=args.global_rate,
+        chat_rate=args.chat_rate, retry_after_rate=args.retry_after_rate,
+        retry_after=args.retry_after, error_rate=args.error_rate, seed=args.seed,
+    )
+    server = await api.serve(args.host, args.port)
+    traffic = None
+    if args.traffic:
+        with open(args.users, encoding="utf-8") as f:
+            user_ids = [u["user_id"] for u in json.load(f)]
+        commands = [c.strip() for c in args.commands.split(",") if c.strip()]
+        traffic = asyncio.create_task(generate_traffic(api, user_ids, commands, args.traffic))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if traffic is not None:
+            traffic.cancel()
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    try:
+        asyncio.run(run(parse_args(argv)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+Офлайн-бенчмарк хендлеров bot.py.
+
+Поднимает настоящее Application из build_application(), но вместо
+HTTP к Telegram подставляет FakeRequest, который отвечает на любой
+метод Bot API мгновенно и только считает вызовы. Данные — синтетические
+(bench/datasets.py) во временной папке, так что рабочие JSON-файлы и
+очередь отправки не трогаются. Апдейты собираются как от Telegram и
+проходят через app.process_update(), то есть через фильтры,
+ConversationHandler и метрики — так же, как в проде.
+
+Каждый размер данных гоняется в отдельном процессе, чтобы пиковая
+память (ru_maxrss) относилась только к нему.
+
+    python bench/replay.py                       # 10, 1000 и 100000 записей
+    python bench/replay.py --sizes 10,1000 --save bench/baseline.json
+    python bench/replay.py --sizes 1000 --baseline bench/baseline.json
+
+С --baseline скрипт завершается с кодом 1, если p99 какого-то сценария
+выросло больше чем в --tolerance раз (и больше чем на --slack-ms).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import datasets  # noqa: E402
+
+DEFAULT_SIZES = (10, 1000, 100000)
+# Сколько раз гонять каждый сценарий; рассылка идёт на всех участников,
+# поэтому для неё повторов меньше
+DEFAULT_ITERATIONS = 200
+BROADCAST_ITERATIONS = 3
+SCENARIOS = (
+    "start", "my_task", "upcoming_events", "get_task",
+    "give_points", "task_done", "broadcast_message", "flush",
+)
+
+
+class FakeRequest(BaseRequest):
+    """BaseRequest без сети: на каждый метод Bot API сразу отвечает ok."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _result(self, method, parameters):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method in ("sendMessage", "editMessageText"):
+            self._message_id += 1
+            return {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": parameters.get("chat_id", 0), "type": "private"},
+                "text": parameters.get("text", ""),
+            }
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        parameters = request_data.parameters if request_data else {}
+        body = {"ok": True, "result": self._result(api_method, parameters)}
+        return 200, json.dumps(body).encode()
+
+
+def percentile(sorted_values, q):
+    """Перцентиль по ближайшему рангу; sorted_values отсортирован по возрастанию."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_mb():
+    # В Linux ru_maxrss — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Replay:
+    def __init__(self, bot_module, app, request, rng):
+        self.bot = bot_module
+        self.store = bot_module.store
+        self.app = app
+        self.request = request
+        self.rng = rng
+        self._update_id = 0
+
+    def update(self, user_id, text):
+        self._update_id += 1
+        message = {
+            "message_id": self._update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return Update.de_json({"update_id": self._update_id, "message": message}, self.app.bot)
+
+    def members(self):
+        return [u for u in self.store.users if u["user_id"] != self.bot.ADMIN_ID]
+
+    # --- Сценарии: каждый отдаёт (список апдейтов одного замера, уборка или None) ---
+
+    def start(self):
+        user = self.rng.choice(self.members())
+        return [self.update(user["user_id"], "/start")], None
+
+    def my_task(self):
+        busy = [u for u in self.members() if u.get("reserved_tasks")] or self.members()
+        user = self.rng.choice(busy)
+        return [self.update(user["user_id"], "/my_task")], None
+
+    def upcoming_events(self):
+        user = self.rng.choice(self.members())
+        return [self.update(user["user_id"], "/upcoming_events")], None
+
+    def get_task(self):
+        """Весь диалог: /get_task, проект, номер задачи, «да». После замера задача освобождается."""
+        candidates = [u for u in self.members() if not u.get("reserved_tasks")]
+        self.rng.shuffle(candidates)
+        for user in candidates:
+            roles = [r.lower() for r in user.get("roles", [])]
+            for project in self.bot.PROJECTS:
+                open_tasks = self.store.open_tasks(project, roles)
+                if not open_tasks:
+                    continue
+                task_id = open_tasks[0]["id"]
+                user_id = user["user_id"]
+                updates = [
+                    self.update(user_id, "/get_task"),
+                    self.update(user_id, project),
+                    self.update(user_id, str(task_id)),
+                    self.update(user_id, "да"),
+                ]
+
+                def cleanup():
+                    self.store.remove_task_events(task_id)
+                    self.store.release_task(task_id)
+                return updates, cleanup
+        return None
+
+    def give_points(self):
+        user = self.rng.choice(self.members())
+        # Команда берёт проект одним словом (args[1]), баллы — args[2]
+        # и ждёт хотя бы ещё один аргумент; шлём её в этом виде
+        project = self.rng.choice([p for p in self.bot.PROJECTS if " " not in p])
+        text = f'/give_points {user["username"]} {project} 5 бенчмарк'
+        return [self.update(self.bot.ADMIN_ID, text)], None
+
+    def task_done(self):
+        reserved = [t["id"] for t in self.store.tasks if t.get("reserved_by")]
+        if not reserved:
+            return None
+        task_id = self.rng.choice(reserved)
+        return [self.update(self.bot.ADMIN_ID, f"/task_done {task_id}")], None
+
+    def broadcast_message(self):
+        return [self.update(self.bot.ADMIN_ID, "/broadcast Собрание в пятницу")], None
+
+    async def run(self, name, iterations):
+        latencies = []
+        sent_before = self.request.calls["sendMessage"]
+        wall = 0.0
+        for _ in range(iterations):
+            if name == "flush":
+                # Что-то поменяем, чтобы flush было что писать
+                user = self.rng.choice(self.members())
+                self.store.add_points(user["user_id"], "Unsouled", 1)
+                started = time.perf_counter()
+                await self.store.flush()
+                elapsed = time.perf_counter() - started
+            else:
+                sample = getattr(self, name)()
+                if sample is None:
+                    break
+                updates, cleanup = sample
+                started = time.perf_counter()
+                for update in updates:
+                    await self.app.process_update(update)
+                elapsed = time.perf_counter() - started
+                if cleanup:
+                    cleanup()
+                # Уведомления уходят через очередь — дождёмся её вне замера,
+                # чтобы доставка не наслаивалась на следующий сэмпл
+                while len(self.bot.outbox):
+                    await asyncio.sleep(0.001)
+            latencies.append(elapsed)
+            wall += elapsed
+        latencies.sort()
+        return {
+            "samples": len(latencies),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "throughput": len(latencies) / wall if wall else 0.0,
+            "messages": self.request.calls["sendMessage"] - sent_before,
+        }
+
+
+async def run_size(size, iterations, seed):
+    """Гоняет все сценарии на одном размере данных. Зовётся в отдельном процессе."""
+    import bot
+    from sender import Broadcaster
+    from storage import JsonBackend
+
+    logging.basicConfig(level=logging.WARNING)
+    warnings.filterwarnings("ignore")
+    result = {"size": size, "scenarios": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        data = datasets.generate(size, bot.ADMIN_ID, seed=seed)
+        paths = {}
+        for name, records in data.items():
+            paths[name] = os.path.join(tmp, f"{name}.json")
+            with open(paths[name], "w", encoding="utf-8") as f:
+                json.dump(records, f, ensure_ascii=False)
+
+        bot.store.backend = JsonBackend(paths["users"], paths["tasks"], paths["events"])
+        started = time.perf_counter()
+        bot.store.load()
+        result["load_ms"] = (time.perf_counter() - started) * 1000
+        # Настоящие лимиты Telegram здесь только мешают мерить сами хендлеры
+        bot.broadcaster = Broadcaster(global_rate=1e9, per_chat_rate=1e9)
+        bot.outbox.broadcaster = bot.broadcaster
+        bot.outbox.path = os.path.join(tmp, "outbox.jsonl")
+        bot.outbox.dead_path = os.path.join(tmp, "outbox_dead.jsonl")
+        bot.ledger.path = os.path.join(tmp, "delivered.bin")
+
+        request = FakeRequest()
+        app = bot.build_application(request=request)
+        await app.initialize()
+        bot.outbox.start(app.bot)
+        replay = Replay(bot, app, request, random.Random(seed))
+        try:
+            for name in SCENARIOS:
+                count = BROADCAST_ITERATIONS if name == "broadcast_message" else iterations
+                result["scenarios"][name] = await replay.run(name, count)
+        finally:
+            await bot.outbox.stop()
+            await app.shutdown()
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_isolated(size, iterations, seed):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", str(size),
+         "--iterations", str(iterations), "--seed", str(seed)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_table(results):
+    header = f"{'size':>7} {'scenario':<18} {'n':>5} {'p50 ms':>9} {'p99 ms':>9} {'ops/s':>9} {'msgs':>7}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        for name, s in result["scenarios"].items():
+            print(f"{result['size']:>7} {name:<18} {s['samples']:>5} {s['p50_ms']:>9.2f} "
+                  f"{s['p99_ms']:>9.2f} {s['throughput']:>9.1f} {s['messages']:>7}")
+        print(f"{result['size']:>7} {'load':<18} {'':>5} {result['load_ms']:>9.1f}"
+              f"   peak RSS {result['peak_rss_mb']:.1f} MB")
+
+
+def compare(results, baseline, tolerance, slack_ms):
+    """Список регрессий p99 по сравнению с baseline (тот же формат, что --save)."""
+    previous = {r["size"]: r["scenarios"] for r in baseline}
+    regressions = []
+    for result in results:
+        for name, s in result["scenarios"].items():
+            old = previous.get(result["size"], {}).get(name)
+            if old is None:
+                continue
+            if s["p99_ms"] > old["p99_ms"] * tolerance and s["p99_ms"] - old["p99_ms"] > slack_ms:
+                regressions.append(
+                    f"{result['size']} {name}: p99 {old['p99_ms']:.2f} -> {s['p99_ms']:.2f} ms"
+                )
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк хендлеров бота")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Размеры данных через запятую")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="Записать результаты в JSON (будущий baseline)")
+    parser.add_argument("--baseline", help="Сравнить с сохранённым baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="Во сколько раз p99 может вырасти без ошибки")
+    parser.add_argument("--slack-ms", type=float, default=1.0,
+                        help="Рост p99 меньше этого не считается регрессией")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.worker is not None:
+        print(json.dumps(asyncio.run(run_size(args.worker, args.iterations, args.seed))))
+        return 0
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    results = [run_isolated(size, args.iterations, args.seed) for size in sizes]
+    print_table(results)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.slack_ms)
+        if regressions:
+            print("\nРегрессии p99:")
+            for line in regressions:
+                print("  " + line)
+            return 1
+        print("\nРегрессий нет.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
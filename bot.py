@@ -1,111 +1,119 @@
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, BotCommand
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, ContextTypes,
+    ApplicationBuilder, CallbackQueryHandler, CommandHandler, ContextTypes,
     ConversationHandler, MessageHandler, filters, JobQueue
 )
-import json
+from telegram.error import BadRequest
+import argparse
+import functools
+import html
+import logging
 import os
+import time
 from datetime import datetime, timedelta
 import re
 from zoneinfo import ZoneInfo
 
+from scheduler import REMINDERS, EventScheduler
+from sender import Broadcaster
+from access import AccessCache
+from locks import AlreadyRunningError, LockManager, acquire_instance_lock
+from logs import setup_logging
+import metrics
+from ledger import DeliveryLedger
+from metrics import HANDLER_ERRORS, HANDLER_SECONDS
+from outbox import Outbox
+from pagination import CALLBACK_PREFIX, SortedView, build_page, decode_cursor
+from processor import ChatOrderedUpdateProcessor
+from search import TaskSearchIndex
+from snapshot import MOMENT
+from storage import JsonBackend, ReservationError, SqliteBackend, Store
+from templates import CardCache, chunk_cards, format_datetime_rus, render_list
+from timeline import EventTimeline
+
 EVENTS_FILE = os.path.join(os.path.dirname(__file__), "events.json")
 TASKS_FILE = os.path.join(os.path.dirname(__file__), "tasks.json")
 USERS_FILE = os.path.join(os.path.dirname(__file__), "users.json")
+# Где хранить состояние: "json" (файлы выше) или "sqlite" (DB_FILE).
+# Перенести данные из JSON в SQLite: python storage.py bot.db users.json tasks.json events.json
+STORAGE_BACKEND = os.environ.get("BOT_STORAGE", "json")
+DB_FILE = os.environ.get("BOT_DB_FILE", os.path.join(os.path.dirname(__file__), "bot.db"))
+# Журнал очереди исходящих сообщений и недоставленные сообщения (dead letter)
+OUTBOX_FILE = os.environ.get("BOT_OUTBOX_FILE", os.path.join(os.path.dirname(__file__), "outbox.jsonl"))
+DEAD_LETTER_FILE = os.environ.get(
+    "BOT_DEAD_LETTER_FILE", os.path.join(os.path.dirname(__file__), "outbox_dead.jsonl")
+)
+# Кому какие напоминания уже доставлены — чтобы не слать их повторно
+LEDGER_FILE = os.environ.get("BOT_LEDGER_FILE", os.path.join(os.path.dirname(__file__), "delivered.bin"))
+# Сколько помнить доставку и как часто выбрасывать старые записи
+LEDGER_TTL = timedelta(days=7)
+LEDGER_COMPACT_INTERVAL = 6 * 60 * 60
+# Эксклюзивный замок на данные: второй процесс бота над ними не запустится
+LOCK_FILE = os.environ.get("BOT_LOCK_FILE", os.path.join(os.path.dirname(__file__), "bot.lock"))
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "7833612109:AAGfBTL2pn5WqDoWLwFYA1cZBd-XF7VzJ_o")
+# Адрес Bot API без токена; для прогонов без сети — bench/fake_api.py
+BOT_API_URL = os.environ.get("BOT_API_URL")
 ADMIN_ID = 1847178297
+# Как часто сбрасывать изменения состояния на диск (секунды)
+FLUSH_INTERVAL = 5
+# Сколько чатов обрабатывать параллельно (апдейты одного чата — всегда по порядку)
+MAX_CONCURRENT_UPDATES = int(os.environ.get("BOT_MAX_CONCURRENT_UPDATES", 16))
+# Где отдавать метрики Prometheus (порт 0 — не отдавать; по умолчанию выключено)
+METRICS_HOST = os.environ.get("BOT_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("BOT_METRICS_PORT", 0))
+# Даты без смещения в событиях и задачах — это время команды
+WORK_TZ = ZoneInfo("Europe/Kiev")
+
+if STORAGE_BACKEND == "sqlite":
+    store = Store(SqliteBackend(DB_FILE), tz=WORK_TZ)
+else:
+    store = Store(JsonBackend(USERS_FILE, TASKS_FILE, EVENTS_FILE), tz=WORK_TZ)
+broadcaster = Broadcaster()
+ledger = DeliveryLedger(LEDGER_FILE, ttl=LEDGER_TTL)
+outbox = Outbox(OUTBOX_FILE, DEAD_LETTER_FILE, broadcaster, ledger=ledger)
+locks = LockManager()
+access = AccessCache(store, ADMIN_ID)
+update_processor = ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES)
+logger = logging.getLogger("bot")
+
+metrics.Gauge("bot_update_backlog", "Апдейты, ждущие в очередях чатов",
+              lambda: update_processor.backlog)
+metrics.Gauge("bot_active_chats", "Чаты, апдейты которых сейчас обрабатываются",
+              lambda: update_processor.stats()["active_chats"])
+metrics.Gauge("bot_outbox_pending", "Сообщения в очереди отправки", lambda: len(outbox))
 
 SELECT_PROJECT, SELECT_TASK, CONFIRM = range(3)
 
-month_names = {
-    1: "января", 2: "февраля", 3: "марта", 4: "апреля", 5: "мая", 6: "июня",
-    7: "июля", 8: "августа", 9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"
-}
+PROJECTS = ["Starky Jungle", "Ideal Abyss", "Unsouled", "Non-project work"]
 
-WORK_TZ = ZoneInfo("Europe/Kiev") 
+cards = CardCache(store)
+task_index = TaskSearchIndex(store)
+timeline = EventTimeline(store)
+# Сколько задач показывать в результатах поиска
+SEARCH_LIMIT = 20
 
 async def check_user_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    users = load_json("users.json")
     user_id = update.effective_user.id if update.effective_user else None
     if not user_id:
         return False
 
-    user = next((u for u in users if u["user_id"] == user_id), None)
-    if not user:
-        await update.message.reply_text(
+    if access.is_member(user_id):
+        return True
+    # Постороннему отвечаем не на каждое сообщение, а раз в access.deny_ttl
+    if update.effective_message and access.should_warn(user_id):
+        await update.effective_message.reply_text(
             "⚠️ Извините, бот работает только с участниками команды.\n"
             "По вопросам обращайтесь к @StanPaige."
         )
-        return False
-    return True
-
-def format_datetime_rus(dt: datetime) -> str:
-    return f"{dt.day} {month_names[dt.month]} в {dt.strftime('%H:%M')}"
+    return False
 
-def recalculate_percent_rates():
-    try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            users = json.load(f)
-
-        total_points = sum(user["points"] for user in users if user["points"] > 0)
-
-        if total_points == 0:
-            for user in users:
-                user["percent_rate"] = 0.0
-        else:
-            for user in users:
-                user["percent_rate"] = round(user["points"] / total_points, 3)  # Округляем до тысячных
-
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
-
-        print("✅ Процентные ставки обновлены.")
-    except Exception as e:
-        print(f"❌ Ошибка при перерасчете ставок: {e}")
+def is_owner(user) -> bool:
+    """Владелец бота — ему доступны команды управления. user — telegram.User (может быть None)."""
+    return user is not None and access.is_owner(user.id)
 
-def add_points(user_id: int, points: int):
-    try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            users = json.load(f)
-
-        for user in users:
-            if user["user_id"] == user_id:
-                user["points"] += points
-                break
-        else:
-            print("❌ Пользователь не найден.")
-            return
-
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
-
-        recalculate_percent_rates()
-
-    except Exception as e:
-        print(f"❌ Ошибка при добавлении баллов: {e}")
-
-def load_json(path):
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            print(f"✅ Загружено {len(data)} объектов из {path}")
-            return data
-    except FileNotFoundError:
-        print(f"❌ Файл не найден: {path}")
-        return []
-    except json.JSONDecodeError as e:
-        print(f"❌ Ошибка декодирования JSON в {path}: {e}")
-        return []
-    except Exception as e:
-        print(f"❌ Неизвестная ошибка при загрузке {path}: {e}")
-        return []
-
-def save_json(path, data):
-    try:
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-            print(f"💾 Сохранено {len(data)} объектов в {path}")
-    except Exception as e:
-        print(f"❌ Ошибка при сохранении {path}: {e}")
+def is_admin(user) -> bool:
+    """Участник с ролью admin (search_task, task_done). user — telegram.User (может быть None)."""
+    return user is not None and access.is_admin(user.id)
 
 async def safe_reply(update: Update, context: ContextTypes.DEFAULT_TYPE,
                      text: str, markup=None):
@@ -123,97 +131,190 @@ async def safe_reply(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 chat_id=update.effective_chat.id, text=text, reply_markup=markup
             )
     except Exception as e:
-        print("❌ safe_reply error:", e)
+        logger.error("❌ safe_reply error: %s", e)
 
-async def event_auto_notify(context: ContextTypes.DEFAULT_TYPE):
-    events = load_json(EVENTS_FILE)
-    users = load_json(USERS_FILE)
-    tasks = load_json(TASKS_FILE)
-    now = datetime.now(WORK_TZ)
+async def fire_event(context: ContextTypes.DEFAULT_TYPE, event, kind):
+    """Срабатывание события из планировщика: напоминание или его наступление."""
+    users = list(store.users)
 
-    changed = False
+    # За 24 и за 2 часа
+    if kind in REMINDERS:
+        await send_event_notification(event, users, context, kind)
+        event[f"notified_{kind}"] = True
+        store.mark_dirty("events", event["id"])
+        return
 
-    for event in events[:]:
-        try:
-            dt = datetime.fromisoformat(event["datetime"]).replace(tzinfo=WORK_TZ)
-            delta = dt - now
-
-            if not event.get("notify_users"):
-                continue
-
-            # За 24 часа
-            if 23 <= delta.total_seconds() / 3600 <= 25 and not event.get("notified_24h"):
-                await send_event_notification(event, users, context, "24")
-                event["notified_24h"] = True
-                changed = True
-
-            # За 2 часа
-            if 1.5 <= delta.total_seconds() / 3600 <= 2.5 and not event.get("notified_2h"):
-                await send_event_notification(event, users, context, "2")
-                event["notified_2h"] = True
-                changed = True
-            
-             # ⏰ Проверка истечения события
-            if now >= dt:
-                if event["type"] == "meeting":
-                    # Рассылка о начале собрания
-                    await send_event_message(event, users, context, f"📣 Собрание \"{event['title']}\" началось!")
-                elif event["type"] == "deadline":
-                    # Найти задачу и снять её с пользователя
-                    task_id = event.get("task_id")
-                    if task_id:
-                        for t in tasks:
-                            if t["id"] == task_id:
-                                reserved_by = t.get("reserved_by")
-                                if reserved_by:
-                                    for u in users:
-                                        if reserved_by == u["user_id"]:
-                                            if "reserved_tasks" in u and task_id in u["reserved_tasks"]:
-                                                u["reserved_tasks"].remove(task_id)
-                                t["reserved_by"] = None
-                                t["deadline"] = None
-                                break
-
-                        await send_event_message(event, users, context, 
-                            f"⏰ Дедлайн по задаче \"{event['title']}\" истёк!\n"
-                            "Задача изымается и становится доступной другим участникам.")
-
-                    changed = True
-
-                # Удалить событие из списка
-                events.remove(event)
-                changed = True
-
-        except Exception as e:
-            print(f"❌ Ошибка авто-оповещения: {e}")
-
-    if changed:
-        save_json(EVENTS_FILE, events)
-        save_json(TASKS_FILE, tasks)
-        save_json(USERS_FILE, users)
-
-async def send_event_notification(event, users, context, when_str):
-    dt = datetime.fromisoformat(event["datetime"]).replace(tzinfo=WORK_TZ)
-    simple_time = f"{dt.day} {month_names[dt.month]} в {dt.strftime('%H:%M')}"
+    # ⏰ Событие наступило. Сначала меняем состояние одним коммитом,
+    # а рассылаем уже потом, чтобы сбой отправки не оставил задачу
+    # снятой, а событие — живым.
+    task_id = event.get("task_id") if event["type"] == "deadline" else None
+    owner = event["users"][0] if event.get("users") else None
+    keys = [("event", event["id"])]
+    if task_id:
+        keys.append(("task", task_id))
+    if owner:
+        keys.append(("user", owner))
+    async with locks.hold(*keys):
+        # Пока ждали замок, событие могли удалить или перенести
+        if store.get_event(event["id"]) is not event:
+            return
+        moment = store.event_time(event["id"])
+        if moment is None or moment.dt > datetime.now(WORK_TZ):
+            return
+        with store.transaction():
+            if task_id and owner:
+                # Снять задачу с пользователя — только если она всё ещё у него.
+                # Дедлайн без исполнителя (задачу никто не держал, когда его
+                # ставили) ничего не снимает: иначе он отобрал бы задачу
+                # у того, кто взял её позже.
+                store.release_task(task_id, expected_user=owner)
+            # Удалить событие из списка
+            store.remove_event(event["id"])
+
+    if event["type"] == "meeting":
+        # Рассылка о начале собрания
+        await send_event_message(event, users, context, f"📣 Собрание \"{event['title']}\" началось!",
+                                 (event["id"], moment.epoch, kind))
+    elif task_id and owner:
+        await send_event_message(event, users, context,
+            f"⏰ Дедлайн по задаче \"{event['title']}\" истёк!\n"
+            "Задача изымается и становится доступной другим участникам.",
+            (event["id"], moment.epoch, kind))
+
+def set_deadline_event(task_id, user_id, deadline, description):
+    """
+    Ставит задаче дедлайн-событие на deadline (ISO-строка) для user_id
+    (None — задача ни за кем не закреплена). У задачи одно такое событие:
+    существующее переносится и передаётся новому исполнителю, лишние
+    удаляются — иначе для одной задачи сработали бы два истечения.
+    """
+    users = [user_id] if user_id else []
+    existing = [e for e in store.task_events(task_id) if e["type"] == "deadline"]
+    if existing:
+        event, *extra = existing
+        for old in extra:
+            store.remove_event(old["id"])
+        # Новая дата или новый исполнитель — напоминания должны прийти заново
+        return store.update_event(event["id"], datetime=deadline, users=users, description=description,
+                                  notified_24h=False, notified_2h=False)
+    event = {
+        "id": store.next_event_id(),
+        "type": "deadline",
+        "title": f"Дедлайн по задаче #{task_id}",
+        "description": description,
+        "datetime": deadline,
+        "notify_users": True,
+        "personal": True,
+        "users": users,
+        "task_id": task_id
+    }
+    store.add_event(event)
+    return event
+
+def event_recipients(event, users):
+    """chat_id участников, которым адресовано событие (всем или только персонально)."""
+    if event.get("personal"):
+        allowed = set(event.get("users", []))
+        return [u["user_id"] for u in users if u["user_id"] in allowed]
+    return [u["user_id"] for u in users]
+
+async def send_event_notification(event, users, context, kind):
+    """
+    Ставит в очередь напоминание kind ("24h"/"2h"). Тем, кому оно уже
+    доставлено (повторное срабатывание после перезапуска), не шлём.
+    """
+    when_str = kind.rstrip("h")
+    moment = store.event_time(event["id"])
+    simple_time = format_datetime_rus(moment.dt)
     event_text = (
         f"⏰ Напоминание! До события <b>{event['title']}</b> осталось {when_str} часа(ов)!\n\n"
         f"🕒 Когда: {simple_time}\n\n"
         f"{event['description']}"
     )
-    success, failed = 0, 0
+    queued = await outbox.fan_out(event_recipients(event, users), event_text,
+                                  dedup=(event["id"], moment.epoch, kind), parse_mode="HTML")
+    logger.info("📣 Напоминание по событию #%s (%sh) в очереди: %d получателей",
+                event["id"], when_str, queued)
 
-    for u in users:
-        if event.get("personal") and u["user_id"] not in event.get("users", []):
-            continue
+async def send_event_message(event, users, context, text, dedup):
+    """dedup — (id события, время, вид срабатывания) для журнала доставок."""
+    queued = await outbox.fan_out(event_recipients(event, users), text, dedup=dedup)
+    logger.info("📣 Рассылка по событию #%s в очереди: %d получателей", event["id"], queued)
 
-        try:
-            await context.bot.send_message(chat_id=u["user_id"], text=event_text, parse_mode="HTML")
-            success += 1
-        except Exception as e:
-            failed += 1
-            print(f"❌ Не удалось отправить {u['full_name']}: {e}")
+async def send_listing(update: Update, context: ContextTypes.DEFAULT_TYPE, title, card_iter):
+    """
+    Отправляет длинный список карточек частями по границам карточек
+    (до 4096 символов, с целыми тегами) через общий лимитер отправки.
+    """
+    report = await broadcaster.send_parts(
+        context.bot, update.effective_chat.id, chunk_cards(title, card_iter), parse_mode="HTML"
+    )
+    if report.failed:
+        logger.warning("❌ Список отправлен не полностью: %d/%d, ошибки: %s",
+                       report.success, report.total, report.errors)
+    return report
+
+def moment_epoch(moment):
+    # Записи без даты идут в начало списка, как раньше пустая строка
+    return moment.epoch if moment is not None else 0
+
+# Списки строятся из снимка Store: страницы, которые листают через
+# несколько минут, показывают одну версию записей, а не полуизменённые.
+# Даты для сортировки — уже разобранные MOMENT записей снимка, те же, что в карточках.
+def snapshot_tasks():
+    return store.snapshot().tasks.values()
+
+# Фильтры /search_task: имя -> (источник, ключ сортировки, заголовок)
+TASK_LISTINGS = {
+    "all": (snapshot_tasks, lambda t: (0, t["id"]), "📋 Все задачи:\n\n"),
+    "reserved": (lambda: (t for t in snapshot_tasks() if t.get("reserved_by") is not None),
+                 lambda t: (0, t["id"]), "🔒 Занятые задачи:\n\n"),
+    "unreserved": (lambda: (t for t in snapshot_tasks() if t.get("reserved_by") is None),
+                   lambda t: (0, t["id"]), "🆓 Свободные задачи:\n\n"),
+    "deadline": (snapshot_tasks, lambda t: (moment_epoch(t[MOMENT]), t["id"]),
+                 "⏰ Задачи по дедлайну:\n\n"),
+}
+# Списки для постраничного просмотра: имя -> (снимок, заголовок, карточка)
+LISTINGS = {
+    name: (SortedView(store, "task", source, key), title, lambda t: cards.task(t, "admin"))
+    for name, (source, key, title) in TASK_LISTINGS.items()
+}
+LISTINGS["events"] = (
+    SortedView(store, "event", lambda: store.snapshot().events.values(),
+               lambda e: (moment_epoch(e[MOMENT]), e["id"])),
+    "<b>📅 Все события:</b>\n\n",
+    lambda e: cards.event_admin(e, datetime.now(WORK_TZ)),
+)
 
-    print(f"📣 Рассылка по событию #{event['id']} ({when_str}h): Успешно: {success}, Ошибок: {failed}")
+def render_listing(name, cursor=None):
+    view, title, render = LISTINGS[name]
+    return build_page(name, view, cursor, title, render)
+
+async def paginate_listing(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопки «назад/вперёд» под списками: перерисовывает то же сообщение."""
+    query = update.callback_query
+    decoded = decode_cursor(query.data or "")
+    if decoded is None or decoded[0] not in LISTINGS:
+        await query.answer()
+        return
+    name, cursor = decoded
+    # Задачи листают те же, кто может /search_task, события — как /show_all_events
+    allowed = is_admin if name in TASK_LISTINGS else is_owner
+    if not allowed(update.effective_user):
+        await query.answer("❌ Ты слишком слаб чтобы использовать это заклинание", show_alert=True)
+        return
+    await query.answer()
+
+    if not len(LISTINGS[name][0]):
+        await query.edit_message_text("📭 Список пуст.")
+        return
+    text, markup = render_listing(name, cursor)
+    try:
+        await query.edit_message_text(text, parse_mode="HTML", reply_markup=markup)
+    except BadRequest as e:
+        # Повторное нажатие на ту же страницу — менять нечего
+        if "not modified" not in str(e).lower():
+            raise
 
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -249,7 +350,7 @@ async def add_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not message or not user:
         return
     
-    if user.id != ADMIN_ID:
+    if not is_owner(user):
         await message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -266,15 +367,8 @@ async def add_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
         event_type, title, description, dt_str = parts[:4]
         datetime_obj = datetime.fromisoformat(dt_str)
 
-        # Загрузка текущих событий
-        if os.path.exists(EVENTS_FILE):
-            with open(EVENTS_FILE, "r", encoding="utf-8") as f:
-                events = json.load(f)
-        else:
-            events = []
-
         # Новый ID
-        new_id = max([e["id"] for e in events], default=0) + 1
+        new_id = store.next_event_id()
 
         new_event = {
             "id": new_id,
@@ -285,11 +379,7 @@ async def add_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "notify_users": True
         }
 
-        events.append(new_event)
-
-        # Сохранение
-        with open(EVENTS_FILE, "w", encoding="utf-8") as f:
-            json.dump(events, f, ensure_ascii=False, indent=2)
+        store.add_event(new_event)
 
         await message.reply_text(f"✅ Я добавил грядущее событие:\n<b>{title}</b> ({event_type})", parse_mode="HTML")
 
@@ -304,7 +394,7 @@ async def notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user or not message:
         return
 
-    if user.id != ADMIN_ID:
+    if not is_owner(user):
         await message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -314,25 +404,16 @@ async def notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     event_id = int(context.args[0])
 
-    # Загрузка события
-    if not os.path.exists(EVENTS_FILE):
-        await message.reply_text("❌ Файл событий не найден.")
-        return
-
-    with open(EVENTS_FILE, "r", encoding="utf-8") as f:
-        events = json.load(f)
-
-    event = next((e for e in events if e["id"] == event_id), None)
+    event = store.get_event(event_id)
     if not event:
         await message.reply_text("❌ Событие с таким ID не найдено.")
         return
 
-    month_names = {
-        1: "января", 2: "февраля", 3: "марта", 4: "апреля", 5: "мая", 6: "июня",
-        7: "июля", 8: "августа", 9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"
-    }
-    dt = datetime.fromisoformat(event["datetime"]).replace(tzinfo=WORK_TZ)
-    simple_time = f"{dt.day} {month_names[dt.month]} в {dt.strftime('%H:%M')}"
+    moment = store.event_time(event_id)
+    if moment is None:
+        await message.reply_text(f"❌ У события #{event_id} некорректная дата: {event.get('datetime')}")
+        return
+    simple_time = format_datetime_rus(moment.dt)
     # Формируем текст уведомления
     event_text = (
         f"📢 <b>{event['title']}</b>\n\n"
@@ -340,29 +421,11 @@ async def notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"{event['description']}"
     )
 
-    # Загрузка пользователей
-    if not os.path.exists(USERS_FILE):
-        await message.reply_text("❌ Файл users.json не найден.")
-        return
-
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
-        users = json.load(f)
-
-    # Рассылка
-    success, failed = 0, 0
-    for u in users:
-        try:
-            # Если событие персональное и пользователь не в списке — пропускаем
-            if event.get("personal", False) and u["user_id"] not in event.get("users", []):
-                continue
-
-            await context.bot.send_message(chat_id=u["user_id"], text=event_text, parse_mode="HTML")
-            success += 1
-        except Exception as e:
-            failed += 1
-            print(f"❗ Не удалось отправить {u['full_name']} ({u['user_id']}): {e}")
+    # Рассылка (персональное событие — только его участникам)
+    queued = await outbox.fan_out(event_recipients(event, store.users), event_text, parse_mode="HTML")
 
-    await message.reply_text(f"✅ Рассылка завершена.\nУспешно: {success} | Ошибок: {failed}")
+    await message.reply_text(f"✅ Рассылка поставлена в очередь: {queued} получателей.\n"
+                             "Недоставленное можно посмотреть в /outbox")
 
 async def upcoming_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_user_membership(update, context):
@@ -371,46 +434,21 @@ async def upcoming_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
 
     if user is None or chat is None:
-        print("❌ update.effective_user или update.effective_chat вернули None")
+        logger.warning("❌ update.effective_user или update.effective_chat вернули None")
         return
     
     user_id = user.id
 
-    try:
-        with open(EVENTS_FILE, "r", encoding="utf-8") as f:
-            events = json.load(f)
-    except Exception as e:
-        await context.bot.send_message(chat_id=chat.id, text=f"⚠️ Какие то силы мешают мне видеть будущее:\n<code>{e}</code>", parse_mode="HTML")
-        return
-
-    now = datetime.now(WORK_TZ)
-
-    # Отбираем события по времени и доступности (общие или персональные с включением юзера)
-    upcoming = []
-    for event in events:
-        try:
-            dt = datetime.fromisoformat(event["datetime"])
-            if dt < now:
-                continue
-
-            is_personal = event.get("personal", False)
-            if not is_personal or (is_personal and user_id in event.get("users", [])):
-                upcoming.append((dt, event))
-        except:
-            continue
-
-    # Сортировка и ограничение до 5 ближайших
-    upcoming.sort(key=lambda e: e[0])
-    upcoming = upcoming[:5]
+    # 5 ближайших событий: общие и персональные с участием юзера
+    snap = store.snapshot()
+    upcoming = [snap.get_event(event_id)
+                for event_id in timeline.upcoming_ids(user_id, datetime.now(WORK_TZ), limit=5)]
 
     if not upcoming:
         await context.bot.send_message(chat_id=chat.id, text="😌 Видимо в будущем тебя не ждут какие либо события.")
         return
 
-    text = "<b>📅 Ближайшие события:</b>\n\n"
-    for dt, event in upcoming:
-        date_str = format_datetime_rus(dt)
-        text += f"📢 <b>{event['title']}</b>\n🕒 {date_str}\n{event['description']}\n\n"
+    text = render_list("<b>📅 Ближайшие события:</b>\n\n", (cards.event(event) for event in upcoming))
 
     await context.bot.send_message(chat_id=chat.id, text=text.strip(), parse_mode="HTML")
 
@@ -423,7 +461,7 @@ async def give_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     args = context.args if context.args else []
 
-    if user.id != ADMIN_ID:
+    if not is_owner(user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -441,28 +479,95 @@ async def give_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            users = json.load(f)
-
-        for user_data in users:
-            if user_data["username"].lower() == username.lower():
-                user_data.setdefault("points", {}).setdefault(project, 0)
-                user_data["points"][project] += points
-                break
-        else:
+        user_data = store.find_user(username)
+        if not user_data:
             await update.message.reply_text("❌ Пользователь не найден.")
             return
 
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
-
-        recalculate_percent_rates()
+        store.add_points(user_data["user_id"], project, points)
+        store.refresh_percent_rates(project)
         await update.message.reply_text(f"✅ Пользователю @{username} добавлено {points} баллов в проект <b>{project}</b>.",
             parse_mode="HTML")
 
     except Exception as e:
         await update.message.reply_text(f"❌ Произошла ошибка: {e}")
 
+def parse_points_grants(text: str):
+    """
+    Разбирает строки вида "username; проект; количество".
+    Возвращает (начисления [(user, проект, баллы)], ошибки [str]).
+    """
+    grants, errors = [], []
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        parts = [p.strip() for p in line.split(";")]
+        if len(parts) != 3:
+            errors.append(f"Строка {line_no}: нужно 3 поля через ';'")
+            continue
+
+        username, project, amount = parts
+        user_data = store.find_user(username)
+        if not user_data:
+            errors.append(f"Строка {line_no}: пользователь @{username.lstrip('@')} не найден")
+            continue
+        if project not in PROJECTS:
+            errors.append(f"Строка {line_no}: неизвестный проект «{project}»")
+            continue
+        try:
+            grants.append((user_data, project, int(amount)))
+        except ValueError:
+            errors.append(f"Строка {line_no}: количество баллов должно быть числом")
+    return grants, errors
+
+async def give_points_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await check_user_membership(update, context):
+        return
+    if not update.message or not update.effective_user:
+        return
+
+    if not is_owner(update.effective_user):
+        await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
+        return
+
+    # Всё после самой команды, включая переносы строк
+    parts = (update.message.text or "").split(None, 1)
+    if len(parts) < 2:
+        await update.message.reply_text(
+            "⚠️ Формат: каждая строка — <code>username; проект; количество</code>\n\n"
+            "Пример:\n"
+            "<code>/give_points_bulk\n"
+            "Franky126866; Starky Jungle; 20\n"
+            "magnewitz; Ideal Abyss; 15</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    grants, errors = parse_points_grants(parts[1])
+    if errors:
+        # Всё или ничего: при любой ошибке ничего не начисляем
+        await update.message.reply_text(
+            "❌ Баллы не начислены, исправь ошибки:\n" + "\n".join(errors)
+        )
+        return
+    if not grants:
+        await update.message.reply_text("⚠️ Не найдено ни одной строки с начислением.")
+        return
+
+    store.add_points_bulk([(u["user_id"], project, points) for u, project, points in grants])
+
+    # Сводка: участник -> проект -> сумма
+    summary = {}
+    for u, project, points in grants:
+        per_project = summary.setdefault(u["username"], {})
+        per_project[project] = per_project.get(project, 0) + points
+
+    text = f"✅ Начислено баллов: {len(grants)} строк(и)\n\n"
+    for username, per_project in summary.items():
+        details = ", ".join(f"{project}: {points:+}" for project, points in per_project.items())
+        text += f"🔹 @{html.escape(username)} — {html.escape(details)}\n"
+    await update.message.reply_text(text, parse_mode="HTML")
+
 async def my_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_user_membership(update, context):
         return  # пользователь не в команде — дальше не идём
@@ -472,24 +577,21 @@ async def my_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg_user_id = update.effective_user.id
 
     try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            users = json.load(f)
-
-        for user in users:
-            if user.get("user_id") == tg_user_id:
-                text = "📊 <b>Твои баллы и ставки:</b>\n\n"
+        user = store.snapshot().get_user(tg_user_id)
+        if not user:
+            await update.message.reply_text("❌ Ты почему то отстутствуешь в системе реестра империи.")
+            return
 
-                points_dict = user.get("points", {})
-                percent_dict = user.get("percent_rate", {})
+        text = "📊 <b>Твои баллы и ставки:</b>\n\n"
 
-                for project in points_dict.keys():
-                    points = points_dict.get(project, 0)
-                    percent = percent_dict.get(project, 0) * 100
-                    text += f"🔹 <b>{project}</b>: {points} баллов ({round(percent)}%)\n"
-                await update.message.reply_text(text, parse_mode="HTML")
-                return
+        points_dict = user.get("points", {})
+        percent_dict = user.get("percent_rate", {})
 
-        await update.message.reply_text("❌ Ты почему то отстутствуешь в системе реестра империи.")
+        for project in points_dict.keys():
+            points = points_dict.get(project, 0)
+            percent = percent_dict.get(project, 0) * 100
+            text += f"🔹 <b>{project}</b>: {points} баллов ({round(percent)}%)\n"
+        await update.message.reply_text(text, parse_mode="HTML")
 
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {e}")
@@ -500,7 +602,7 @@ async def check_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.effective_user:
         return
 
-    if update.effective_user.id != ADMIN_ID:
+    if not is_owner(update.effective_user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -511,24 +613,21 @@ async def check_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = context.args[0].lstrip("@")
 
     try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            users = json.load(f)
-
-        for user in users:
-            if user["username"].lower() == username.lower():
-                text = f"📊 <b>Баллы @{username}:</b>\n\n"
+        user = store.snapshot().find_user(username)
+        if not user:
+            await update.message.reply_text("❌ Пользователь не найден.")
+            return
 
-                points_dict = user.get("points", {})
-                percent_dict = user.get("percent_rate", {})
+        text = f"📊 <b>Баллы @{username}:</b>\n\n"
 
-                for project in points_dict.keys():
-                    points = points_dict.get(project, 0)
-                    percent = percent_dict.get(project, 0) * 100
-                    text += f"🔹 <b>{project}</b>: {points} баллов ({round(percent)}%)\n"
-                await update.message.reply_text(text, parse_mode="HTML")
-                return
+        points_dict = user.get("points", {})
+        percent_dict = user.get("percent_rate", {})
 
-        await update.message.reply_text("❌ Пользователь не найден.")
+        for project in points_dict.keys():
+            points = points_dict.get(project, 0)
+            percent = percent_dict.get(project, 0) * 100
+            text += f"🔹 <b>{project}</b>: {points} баллов ({round(percent)}%)\n"
+        await update.message.reply_text(text, parse_mode="HTML")
 
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {e}")
@@ -536,9 +635,8 @@ async def check_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def get_task_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_user_membership(update, context):
         return  # пользователь не в команде — дальше не идём
-    users = load_json("users.json")
     user_id = update.effective_user.id if update.effective_user else None
-    user = next((u for u in users if u["user_id"] == user_id), None)
+    user = store.get_user(user_id)
 
     if not user:
         await safe_reply(update, context, "⚠️ Почему тебя нет в реестре империи?")
@@ -549,11 +647,9 @@ async def get_task_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await safe_reply(update, context, "⚠️ Ты не можешь брать более 3 задач одновременно!")
         return ConversationHandler.END
 
-    # Пока только один проект
-    projects = ["Starky Jungle", "Ideal Abyss", "Unsouled", "Non-project work"]
     context.user_data["user_id"] = user_id
 
-    markup = ReplyKeyboardMarkup([[p] for p in projects], one_time_keyboard=True, resize_keyboard=True)
+    markup = ReplyKeyboardMarkup([[p] for p in PROJECTS], one_time_keyboard=True, resize_keyboard=True)
     await safe_reply(update, context, "🔧 Выберите проект:", markup)
     return SELECT_PROJECT
 
@@ -564,47 +660,26 @@ async def select_project(update: Update, context: ContextTypes.DEFAULT_TYPE):
     project = update.message.text
     context.user_data["project"] = project
 
-    users = load_json("users.json")
-    tasks = load_json("tasks.json")
     user_id = context.user_data["user_id"]
-    user = next((u for u in users if u["user_id"] == user_id), None)
+    user = store.get_user(user_id)
 
     if not user:
         return await safe_reply(update, context, "⚠️ Кто ты, воин?")
 
     roles = [r.lower() for r in user.get("roles", [])]
 
-    relevant_tasks = [
-        t for t in tasks
-        if t.get("project") == project and
-           t.get("reserved_by") is None and
-           t.get("type", "").lower() in roles
-    ]
+    relevant_tasks = store.open_tasks(project, roles)
 
     if not relevant_tasks:
         await safe_reply(update, context, "😔 Сейчас нет доступных миссий для твоей роли")
         return ConversationHandler.END
 
-    msg = "📝 Доступные задачи:\n\n"
-    for t in relevant_tasks:
-        estimated_days = t.get("estimated_days", 7)
-        if estimated_days >= 7:
-            weeks = estimated_days // 7
-            days = estimated_days % 7
-            if days == 0:
-                time_str = f"{weeks} нед."
-            else:
-                time_str = f"{weeks} нед. {days} дн."
-        else:
-            time_str = f"{estimated_days} дн."
-        msg += (f"🔹 <b>{t['title']}</b> (#{t['id']})\n"
-                f"📄 {t['description']}\n"
-                f"📂 Тип: {t['type']}\n"
-                f"🏆 Баллы: {t['points']}\n"
-                f"⏰ Примерное время: {time_str}\n\n")
-
-    await safe_reply(update, context, msg, markup=ReplyKeyboardRemove())
-    await safe_reply(update, context, "Введите номер задачи, которую хотите взять")
+    # Карточки — из снимка: список уходит частями, а задачи тем временем могут разобрать
+    snap = store.snapshot()
+    await send_listing(update, context, "📝 Доступные задачи:\n\n",
+                       (cards.task(snap.get_task(t["id"])) for t in relevant_tasks))
+    await safe_reply(update, context, "Введите номер задачи, которую хотите взять",
+                     markup=ReplyKeyboardRemove())
     return SELECT_TASK
 
 async def select_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -636,11 +711,7 @@ async def confirm_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not task_id or not user_id:
         return await safe_reply(update, context, "⚠️ Не удалось подтвердить выбор")
 
-    tasks = load_json("tasks.json")
-    users = load_json("users.json")
-    events = load_json("events.json")
-    
-    user = next((u for u in users if u["user_id"] == user_id), None)
+    user = store.get_user(user_id)
     reserved = user.get("reserved_tasks", []) if user else []
 
     if len(reserved) >= 3:
@@ -657,42 +728,20 @@ async def confirm_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return CONFIRM
     
-    deadline = None
-    for task in tasks:
-        if task["id"] == task_id:
-            task["reserved_by"] = user_id
-
-            # Если дедлайна нет, генерируем его
-            if not task.get("deadline"):
-                estimated_days = task.get("estimated_days", 7)
-                new_deadline = datetime.now(WORK_TZ) + timedelta(days=estimated_days)
-                task["deadline"] = new_deadline.isoformat()
-                deadline = task["deadline"]
-            else:
-                deadline = task["deadline"]
-            break
-
-    for user in users:
-        if user["user_id"] == user_id:
-            user.setdefault("reserved_tasks", []).append(task_id)
-            break
-
-    if deadline:
-        events.append({
-            "id": max([e["id"] for e in events], default=0) + 1,
-            "type": "deadline",
-            "title": f"Дедлайн по задаче #{task_id}",
-            "description": "Пожалуйста, завершите работу в срок.",
-            "datetime": deadline,
-            "notify_users": True,
-            "personal": True,
-            "users": [user_id],
-            "task_id": task_id
-        })
-
-    save_json("tasks.json", tasks)
-    save_json("users.json", users)
-    save_json("events.json", events)
+    async with locks.hold(("task", task_id), ("user", user_id)):
+        task = store.get_task(task_id)
+        # Если дедлайна нет, генерируем его
+        estimated_days = task.get("estimated_days", 7) if task else 7
+        new_deadline = datetime.now(WORK_TZ) + timedelta(days=estimated_days)
+        try:
+            with store.transaction():
+                # Задачу мог успеть забрать кто-то другой — берём, только если свободна
+                task = store.try_reserve(task_id, user_id, new_deadline.isoformat(), limit=3)
+                set_deadline_event(task_id, user_id, task["deadline"],
+                                   "Пожалуйста, завершите работу в срок.")
+        except ReservationError as e:
+            await safe_reply(update, context, f"⚠️ {e}")
+            return ConversationHandler.END
 
     await safe_reply(update, context, "✅ Миссия принадлежит теперь вам. Проявите себя достойно!")
     return ConversationHandler.END
@@ -701,16 +750,16 @@ async def my_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_user_membership(update, context):
         return  # пользователь не в команде — дальше не идём
     user_id = update.effective_user.id
-    users = load_json("users.json")
-    tasks = load_json("tasks.json")
+    snap = store.snapshot()
 
-    user = next((u for u in users if u["user_id"] == user_id), None)
+    user = snap.get_user(user_id)
     if not user:
         await update.message.reply_text("⚠️ Почему тебя нет в реестре империи?")
         return
 
-    # Найдем задачи, которые зарезервированы текущим пользователем
-    reserved_tasks = [t for t in tasks if t.get("reserved_by") == user_id]
+    # Задачи, которые зарезервированы текущим пользователем
+    reserved_tasks = [snap.get_task(task_id) for task_id in user.get("reserved_tasks", [])]
+    reserved_tasks = [t for t in reserved_tasks if t and t.get("reserved_by") == user_id]
 
     if not reserved_tasks:
         await update.message.reply_text(
@@ -719,90 +768,44 @@ async def my_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    msg = "📝 Ваши текущие задачи:\n\n"
-    for t in reserved_tasks:
-        # ✅ Защита от null дедлайна
-        if t.get("deadline"):
-            dt = datetime.fromisoformat(t["deadline"]).replace(tzinfo=WORK_TZ)
-            date_str = f"{dt.day} {month_names[dt.month]} в {dt.strftime('%H:%M')}"
-        else:
-            date_str = "Не назначен"
-        msg += (f"🔹 <b>{t['title']}</b> (#{t['id']})\n"
-                f"📄 {t['description']}\n"
-                f"📂 Тип: {t['type']}\n"
-                f"🏆 Баллы: {t['points']}\n"
-                f"⏰ Дедлайн: {date_str}\n\n")
+    msg = render_list("📝 Ваши текущие задачи:\n\n", (cards.task(t, "mine") for t in reserved_tasks))
 
     await update.message.reply_text(msg, parse_mode="HTML")
 
 async def search_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_user_membership(update, context):
         return  # пользователь не в команде — дальше не идём
-    user_id = update.effective_user.id
-    users = load_json("users.json")
-    tasks = load_json("tasks.json")
-
-    user = next((u for u in users if u["user_id"] == user_id), None)
-    if not user or "admin" not in user.get("roles", []) and user.get("role") != "admin":
+    if not is_admin(update.effective_user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
-    # Обработка параметров команды (аргументы)
+    # Фильтр по статусу: reserved/unreserved, сортировка по дедлайну
+    # или произвольный текст для поиска по названию, описанию, проекту и типу
     args = context.args  # список аргументов после /search_task
+    name = args[0].lower() if args else "all"
+    if name not in TASK_LISTINGS:
+        query = " ".join(args)
+        snap = store.snapshot()
+        found = [snap.get_task(task_id) for task_id in task_index.search_ids(query, limit=SEARCH_LIMIT)]
+        if not found:
+            await update.message.reply_text(f"🔎 По запросу «{query}» ничего не нашлось.")
+            return
+        await send_listing(update, context, f"🔎 Задачи по запросу «{html.escape(query)}»:\n\n",
+                           (cards.task(t, "admin") for t in found))
+        return
 
-    filtered_tasks = tasks
-
-    # Например, фильтр по статусу: reserved/unreserved
-    if args:
-        arg = args[0].lower()
-        if arg == "reserved":
-            filtered_tasks = [t for t in tasks if t.get("reserved_by") is not None]
-        elif arg == "unreserved":
-            filtered_tasks = [t for t in tasks if t.get("reserved_by") is None]
-        elif arg == "deadline":
-            filtered_tasks = sorted(tasks, key=lambda t: t.get("deadline") or "")
-
-    if not filtered_tasks:
+    if not len(LISTINGS[name][0]):
         await update.message.reply_text("⚠️ Задачи не найдены с указанными параметрами.")
         return
 
-    msg = "📋 Все задачи:\n\n"
-    for t in filtered_tasks:
-        reserved_by = t.get("reserved_by")
-        reserved_str = f"Зарезервирована пользователем {reserved_by}" if reserved_by else "Свободна"
-        estimated_days = t.get("estimated_days", 7)
-        if estimated_days >= 7:
-            weeks = estimated_days // 7
-            days = estimated_days % 7
-            if days == 0:
-                time_str = f"{weeks} нед."
-            else:
-                time_str = f"{weeks} нед. {days} дн."
-        else:
-            time_str = f"{estimated_days} дн."
-        msg += (f"🔹 <b>{t['title']}</b> (#{t['id']})\n"
-                f"📄 {t['description']}\n"
-                f"📂 Тип: {t['type']}\n"
-                f"🏆 Баллы: {t['points']}\n"
-                f"⏰ Примерное время: {time_str}\n"
-                f"📌 Статус: {reserved_str}\n\n")
-
-    # Разбиваем сообщение на части по 4000 символов, чтобы не превышать лимит Телеграма
-    max_len = 4000
-    for i in range(0, len(msg), max_len):
-        await update.message.reply_text(msg[i:i+max_len], parse_mode="HTML")
+    text, markup = render_listing(name)
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
 
 async def task_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_user_membership(update, context):
         return  # пользователь не в команде — дальше не идём
-    user_id = update.effective_user.id if update.effective_user else None
-    users = load_json("users.json")
-    tasks = load_json("tasks.json")
-    events = load_json("events.json")  # допустим, события в отдельном файле
-
     # Проверка, что вызывающий - админ
-    user = next((u for u in users if u["user_id"] == user_id), None)
-    if not user or ("admin" not in user.get("roles", []) and user.get("role") != "admin"):
+    if not is_admin(update.effective_user):
         await safe_reply(update, context, "⚠️ У вас нет прав для этой команды.")
         return
 
@@ -812,44 +815,38 @@ async def task_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     task_id = int(context.args[0])
 
-    # Найдем задачу по ID
-    task = next((t for t in tasks if t["id"] == task_id), None)
-    if not task:
-        await safe_reply(update, context, f"⚠️ Задача #{task_id} не найдена.")
-        return
+    async with locks.hold(("task", task_id)):
+        # Найдем задачу по ID
+        task = store.get_task(task_id)
+        if not task:
+            await safe_reply(update, context, f"⚠️ Задача #{task_id} не найдена.")
+            return
 
-    reserved_by = task.get("reserved_by")
-    tasks = [t for t in tasks if t["id"] != task_id]
-    save_json(TASKS_FILE, tasks)
+        reserved_by = task.get("reserved_by")
+        with store.transaction():
+            # Задача удаляется и снимается с исполнителя
+            store.remove_task(task_id)
 
-    # Удаляем связанные ивенты по task_id (если есть)
-    events = [e for e in events if e.get("task_id") != task_id]
-    save_json(EVENTS_FILE, events)
-    
-    if reserved_by:
-        for u in users:
-            if task_id in u.get("reserved_tasks", []):
-                u["reserved_tasks"].remove(task_id)
-                break
-        save_json(USERS_FILE, users)
+            # Удаляем связанные ивенты по task_id (если есть)
+            store.remove_task_events(task_id)
 
     await update.message.reply_text(f"✅ Задача #{task_id} успешно помечена как выполненная и удалена.")
 
     # Отправляем уведомление пользователю, если задача была зарезервирована
     if reserved_by:
         try:
-            await context.bot.send_message(
-                chat_id=reserved_by,
-                text=(f"🎉 Задача <b>{task['title']}</b> (#{task_id}) "
-                      "помечена как выполненная. Спасибо за вашу работу!"),
+            await outbox.enqueue(
+                reserved_by,
+                (f"🎉 Задача <b>{task['title']}</b> (#{task_id}) "
+                 "помечена как выполненная. Спасибо за вашу работу!"),
                 parse_mode="HTML"
             )
-        except Exception as e:
-            await update.message.reply_text(f"⚠️ Не удалось отправить уведомление пользователю: {e}")
+        except OSError as e:
+            await update.message.reply_text(f"⚠️ Не удалось поставить уведомление в очередь: {e}")
 
 async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if not user or user.id != ADMIN_ID:
+    if not is_owner(user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -858,8 +855,9 @@ async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/add_event – добавить новое событие в календарь\n"
         "/notify – разослать уведомление о событии по ID\n"
         "/give_points – добавить баллы участнику по username\n"
+        "/give_points_bulk – начислить баллы нескольким участникам (строка на начисление)\n"
         "/check_points – проверить баллы участника по username\n"
-        "/search_task – посмотреть задачи (фильтры: reserved/unreserved/deadline)\n"
+        "/search_task – посмотреть задачи (фильтры: reserved/unreserved/deadline или любой текст для поиска)\n"
         "/task_done – пометить задачу как выполненную и удалить\n"
         "/edit_deadline – редактирование дедлайна задач участников\n"
         "/delete_event – удалить событие по ID\n"
@@ -868,6 +866,7 @@ async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/assign_task – Назначить задачу участнику по username\n"
         "/broadcast – отправить сообщение всем участникам или одному (@username)\n"
         "/show_all_events – увидеть полный список всех событий\n"
+        "/outbox – очередь отправки и недоставленные сообщения (retry — отправить их заново)\n"
         "/delete_event – удалить событие по ID\n"
         # Допиши сюда другие твои админ-команды при необходимости
     )
@@ -878,7 +877,7 @@ async def edit_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user = update.effective_user
-    if not user or user.id != ADMIN_ID:
+    if not is_owner(user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -899,36 +898,16 @@ async def edit_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         new_dt = datetime.fromisoformat(new_dt_str).replace(tzinfo=WORK_TZ)
 
-        tasks = load_json(TASKS_FILE)
-        events = load_json(EVENTS_FILE)
-
-        task = next((t for t in tasks if t["id"] == task_id), None)
+        task = store.get_task(task_id)
         if not task:
             await update.message.reply_text(f"❌ Задача с ID #{task_id} не найдена.")
             return
 
-        task["deadline"] = new_dt.isoformat()
+        store.update_task(task_id, deadline=new_dt.isoformat())
 
         # Обновляем событие или создаём новое
-        event = next((e for e in events if e.get("task_id") == task_id), None)
-        if event:
-            event["datetime"] = new_dt.isoformat()
-        else:
-            new_event = {
-                "id": max([e["id"] for e in events], default=0) + 1,
-                "type": "deadline",
-                "title": f"Дедлайн по задаче #{task_id}",
-                "description": "Обновлён администратором.",
-                "datetime": new_dt.isoformat(),
-                "notify_users": True,
-                "personal": True,
-                "users": [task.get("reserved_by")] if task.get("reserved_by") else [],
-                "task_id": task_id
-            }
-            events.append(new_event)
-
-        save_json(TASKS_FILE, tasks)
-        save_json(EVENTS_FILE, events)
+        set_deadline_event(task_id, task.get("reserved_by"), new_dt.isoformat(),
+                           "Обновлён администратором.")
 
         await update.message.reply_text(
             f"✅ Дедлайн задачи #{task_id} обновлён!\n"
@@ -945,7 +924,7 @@ async def delete_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     user = update.effective_user
-    if not user or user.id != ADMIN_ID:
+    if not is_owner(user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -955,15 +934,13 @@ async def delete_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         event_id = int(context.args[0])
-        events = load_json(EVENTS_FILE)
-        event = next((e for e in events if e["id"] == event_id), None)
+        event = store.get_event(event_id)
 
         if not event:
             await update.message.reply_text(f"❌ Событие с ID #{event_id} не найдено.")
             return
 
-        events = [e for e in events if e["id"] != event_id]
-        save_json(EVENTS_FILE, events)
+        store.remove_event(event_id)
 
         await update.message.reply_text(f"✅ Событие \"{event['title']}\" (ID #{event_id}) успешно удалено.")
 
@@ -977,7 +954,7 @@ async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    if not user or user.id != ADMIN_ID:
+    if not is_owner(user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -1004,8 +981,7 @@ async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         points = int(parts[4].strip())
         estimated_days = int(parts[5].strip())
 
-        tasks = load_json(TASKS_FILE)
-        new_id = max([t["id"] for t in tasks], default=0) + 1
+        new_id = store.next_task_id()
 
         new_task = {
             "id": new_id,
@@ -1019,8 +995,7 @@ async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "reserved_by": None
         }
 
-        tasks.append(new_task)
-        save_json(TASKS_FILE, tasks)
+        store.add_task(new_task)
 
         await update.message.reply_text(
             f"✅ Задача добавлена:\n\n"
@@ -1040,7 +1015,7 @@ async def unassign_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    if not user or user.id != ADMIN_ID:
+    if not is_owner(user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -1050,62 +1025,46 @@ async def unassign_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     task_id = int(context.args[0])
 
-    tasks = load_json(TASKS_FILE)
-    users = load_json(USERS_FILE)
-    events = load_json(EVENTS_FILE)
-
-    task = next((t for t in tasks if t["id"] == task_id), None)
-    if not task:
-        await update.message.reply_text(f"❌ Задача #{task_id} не найдена.")
-        return
-
-    reserved_by = task.get("reserved_by")
-    if not reserved_by:
-        await update.message.reply_text(f"⚠️ Задача #{task_id} уже свободна.")
-        return
-
-    # Найти пользователя и убрать задачу из его списка
-    for u in users:
-        if u["user_id"] == reserved_by:
-            if "reserved_tasks" in u and task_id in u["reserved_tasks"]:
-                u["reserved_tasks"].remove(task_id)
-            break
+    async with locks.hold(("task", task_id)):
+        task = store.get_task(task_id)
+        if not task:
+            await update.message.reply_text(f"❌ Задача #{task_id} не найдена.")
+            return
 
-    # Обнулить задачу
-    task["reserved_by"] = None
-    task["deadline"] = None
+        reserved_by = task.get("reserved_by")
+        if not reserved_by:
+            await update.message.reply_text(f"⚠️ Задача #{task_id} уже свободна.")
+            return
 
-    # Удалить связанный дедлайн-ивент
-    old_events = len(events)
-    events = [e for e in events if e.get("task_id") != task_id]
-    removed = old_events - len(events)
+        with store.transaction():
+            # Убрать задачу у пользователя и обнулить резерв с дедлайном
+            store.release_task(task_id)
 
-    save_json(TASKS_FILE, tasks)
-    save_json(USERS_FILE, users)
-    save_json(EVENTS_FILE, events)
+            # Удалить связанный дедлайн-ивент
+            removed = store.remove_task_events(task_id)
 
     await update.message.reply_text(
         f"✅ Задача #{task_id} теперь свободна. "
         f"Удалено связанных событий: {removed}."
     )
 
-    # Если хочешь, можно уведомить бывшего исполнителя
+    # Уведомляем бывшего исполнителя
     try:
-        await context.bot.send_message(
-            chat_id=reserved_by,
-            text=(f"⚠️ Задача <b>{task['title']}</b> (#{task_id}) "
-                  "была снята с вас администратором и теперь доступна другим."),
+        await outbox.enqueue(
+            reserved_by,
+            (f"⚠️ Задача <b>{task['title']}</b> (#{task_id}) "
+             "была снята с вас администратором и теперь доступна другим."),
             parse_mode="HTML"
         )
-    except Exception as e:
-        print(f"❌ Не удалось уведомить участника: {e}")
+    except OSError as e:
+        logger.warning("❌ Не удалось поставить уведомление в очередь: %s", e)
 
 async def assign_task_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_user_membership(update, context):
         return
 
     user = update.effective_user
-    if not user or user.id != ADMIN_ID:
+    if not is_owner(user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -1123,57 +1082,36 @@ async def assign_task_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE
         task_id = int(context.args[0])
         username = context.args[1].lstrip("@").strip().lower()
 
-        tasks = load_json(TASKS_FILE)
-        users = load_json(USERS_FILE)
-        events = load_json(EVENTS_FILE)
-
-        task = next((t for t in tasks if t["id"] == task_id), None)
-        if not task:
-            await update.message.reply_text(f"❌ Задача #{task_id} не найдена.")
-            return
-
-        if task.get("reserved_by"):
-            await update.message.reply_text(f"⚠️ Задача #{task_id} уже назначена.")
-            return
-
-        user_obj = next((u for u in users if u["username"].lower() == username), None)
+        user_obj = store.find_user(username)
         if not user_obj:
             await update.message.reply_text(f"❌ Пользователь @{username} не найден.")
             return
-
-        # Проставляем резерв
         user_id = user_obj["user_id"]
-        task["reserved_by"] = user_id
 
-        # Генерируем дедлайн, если его ещё нет
-        if not task.get("deadline"):
-            estimated_days = task.get("estimated_days", 7)
-            deadline = datetime.now(WORK_TZ) + timedelta(days=estimated_days)
-            task["deadline"] = deadline.isoformat()
-        else:
-            deadline = datetime.fromisoformat(task["deadline"])
+        async with locks.hold(("task", task_id), ("user", user_id)):
+            task = store.get_task(task_id)
+            if not task:
+                await update.message.reply_text(f"❌ Задача #{task_id} не найдена.")
+                return
 
-        # Добавляем задачу в список пользователя
-        user_obj.setdefault("reserved_tasks", []).append(task_id)
+            if task.get("reserved_by"):
+                await update.message.reply_text(f"⚠️ Задача #{task_id} уже назначена.")
+                return
 
-        # Добавляем ивент-дедлайн
-        new_event = {
-            "id": max([e["id"] for e in events], default=0) + 1,
-            "type": "deadline",
-            "title": f"Дедлайн по задаче #{task_id}",
-            "description": "Администратор назначил вам задачу.",
-            "datetime": deadline.isoformat(),
-            "notify_users": True,
-            "personal": True,
-            "users": [user_id],
-            "task_id": task_id
-        }
-        events.append(new_event)
+            # Генерируем дедлайн, если его ещё нет
+            if not task.get("deadline"):
+                estimated_days = task.get("estimated_days", 7)
+                deadline = datetime.now(WORK_TZ) + timedelta(days=estimated_days)
+            else:
+                deadline = store.task_deadline(task_id).dt
 
-        # Сохраняем изменения
-        save_json(TASKS_FILE, tasks)
-        save_json(USERS_FILE, users)
-        save_json(EVENTS_FILE, events)
+            with store.transaction():
+                # Проставляем резерв и добавляем задачу в список пользователя
+                store.try_reserve(task_id, user_id, deadline.isoformat())
+
+                # Ивент-дедлайн: переносим существующий или добавляем
+                set_deadline_event(task_id, user_id, deadline.isoformat(),
+                                   "Администратор назначил вам задачу.")
 
         await update.message.reply_text(
             f"✅ Задача #{task_id} успешно назначена пользователю @{username}."
@@ -1181,9 +1119,9 @@ async def assign_task_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE
 
         # Отправляем уведомление назначенному пользователю
         try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=(
+            await outbox.enqueue(
+                user_id,
+                (
                     f"📌 Вам назначена новая задача!\n\n"
                     f"<b>{task['title']}</b> (#{task_id})\n"
                     f"{html.escape(task['description'])}\n\n"
@@ -1191,8 +1129,8 @@ async def assign_task_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE
                 ),
                 parse_mode="HTML"
             )
-        except Exception as e:
-            print(f"❌ Не удалось отправить уведомление пользователю: {e}")
+        except OSError as e:
+            logger.warning("❌ Не удалось поставить уведомление в очередь: %s", e)
 
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {e}")
@@ -1202,7 +1140,7 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    if not user or user.id != ADMIN_ID:
+    if not is_owner(user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -1223,85 +1161,87 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         username = parts[0].strip().lstrip("@").lower()
         message_text = parts[1].strip()
 
-        users = load_json(USERS_FILE)
-        user_obj = next((u for u in users if u["username"].lower() == username), None)
+        user_obj = store.find_user(username)
         if not user_obj:
             await update.message.reply_text(f"❌ Пользователь @{username} не найден.")
             return
 
         try:
-            await context.bot.send_message(
-                chat_id=user_obj["user_id"],
-                text=f"📢 Сообщение от администратора:\n\n{message_text}"
+            await outbox.enqueue(
+                user_obj["user_id"],
+                f"📢 Сообщение от администратора:\n\n{message_text}"
             )
-            await update.message.reply_text(f"✅ Сообщение отправлено пользователю @{username}.")
-        except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка при отправке: {e}")
+            await update.message.reply_text(f"✅ Сообщение для @{username} поставлено в очередь.")
+        except OSError as e:
+            await update.message.reply_text(f"❌ Ошибка при постановке в очередь: {e}")
 
     else:
         # Общая рассылка всем
         message_text = raw_input.strip()
-        users = load_json(USERS_FILE)
-        success, failed = 0, 0
-
-        for u in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=u["user_id"],
-                    text=f"📢 Сообщение от администратора:\n\n{message_text}",
-                    parse_mode="HTML"
-                )
-                success += 1
-            except Exception as e:
-                print(f"❌ Ошибка для {u.get('username')}: {e}")
-                failed += 1
+        queued = await outbox.fan_out(
+            [u["user_id"] for u in store.users],
+            f"📢 Сообщение от администратора:\n\n{message_text}",
+            parse_mode="HTML"
+        )
 
         await update.message.reply_text(
-            f"✅ Рассылка завершена.\nОтправлено: {success} | Ошибок: {failed}."
+            f"✅ Рассылка поставлена в очередь: {queued} получателей.\n"
+            "Недоставленное можно посмотреть в /outbox"
         )
 
+async def show_outbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await check_user_membership(update, context):
+        return
+
+    if not is_owner(update.effective_user):
+        await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
+        return
+
+    if context.args and context.args[0].lower() == "retry":
+        count, kept = await outbox.requeue_dead()
+        text = f"🔁 Снова в очереди: {count} сообщений."
+        if kept:
+            text += f"\nУже доставлены или ждут в очереди, оставлены в списке недоставленных: {kept}."
+        await update.message.reply_text(text)
+        return
+
+    stats = outbox.stats()
+    text = (
+        "📨 <b>Очередь отправки</b>\n\n"
+        f"В очереди: {stats['pending']} (отправляется: {stats['sending']})\n"
+        f"Доставлено с запуска: {stats['delivered']}\n"
+        f"Недоставлено: {stats['dead']}\n"
+    )
+    letters = outbox.dead_letters(limit=5)
+    if letters:
+        text += "\n<b>Последние недоставленные:</b>\n"
+        for letter in letters:
+            failed_at = datetime.fromtimestamp(letter["failed_at"], WORK_TZ)
+            preview = letter["text"][:80]
+            text += (
+                f"\n• {format_datetime_rus(failed_at)} → <code>{letter['chat_id']}</code>\n"
+                f"  {html.escape(letter['error'])}\n"
+                f"  <i>{html.escape(preview)}</i>\n"
+            )
+        text += "\nОтправить их заново: /outbox retry"
+    await update.message.reply_text(text, parse_mode="HTML")
+
 async def show_all_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_user_membership(update, context):
         return
 
     user = update.effective_user
-    if not user or user.id != ADMIN_ID:
+    if not is_owner(user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
     try:
-        events = load_json(EVENTS_FILE)
-        if not events:
+        if not len(LISTINGS["events"][0]):
             await update.message.reply_text("📭 Список событий пуст.")
             return
 
-        now = datetime.now(WORK_TZ)
-
-        # Сортируем по дате и времени
-        events_sorted = sorted(events, key=lambda e: e.get("datetime") or "")
-
-        msg = "<b>📅 Все события:</b>\n\n"
-        for event in events_sorted:
-            dt = datetime.fromisoformat(event["datetime"]).replace(tzinfo=WORK_TZ)
-            status = "✅ Актуально" if dt >= now else "⌛ Уже прошло"
-
-            personal_str = ""
-            if event.get("personal", False):
-                personal_str = " (Персональное)"
-            
-            msg += (
-                f"🔹 <b>{event['title']}</b>{personal_str}\n"
-                f"🗂️ Тип: {event['type']}\n"
-                f"🕒 Когда: {format_datetime_rus(dt)}\n"
-                f"📄 {event['description']}\n"
-                f"📌 Статус: {status}\n"
-                f"🆔 ID: {event['id']}\n\n"
-            )
-
-        # Если сообщение слишком большое — разбиваем
-        max_len = 4000
-        for i in range(0, len(msg), max_len):
-            await update.message.reply_text(msg[i:i+max_len], parse_mode="HTML")
+        text, markup = render_listing("events")
+        await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
 
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {e}")
@@ -1311,7 +1251,7 @@ async def delete_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    if not user or user.id != ADMIN_ID:
+    if not is_owner(user):
         await update.message.reply_text("❌ Ты слишком слаб чтобы использовать это заклинание")
         return
 
@@ -1323,16 +1263,14 @@ async def delete_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         event_id = int(context.args[0])
-        events = load_json(EVENTS_FILE)
-        event = next((e for e in events if e["id"] == event_id), None)
+        event = store.get_event(event_id)
 
         if not event:
             await update.message.reply_text(f"❌ Событие с ID #{event_id} не найдено.")
             return
 
         # Удаляем событие
-        events = [e for e in events if e["id"] != event_id]
-        save_json(EVENTS_FILE, events)
+        store.remove_event(event_id)
 
         await update.message.reply_text(f"✅ Событие \"{event['title']}\" (ID #{event_id}) успешно удалено.")
 
@@ -1363,36 +1301,186 @@ def get_task_handler():
     )
 
 
-app = ApplicationBuilder().token("7833612109:AAGfBTL2pn5WqDoWLwFYA1cZBd-XF7VzJ_o").build()
-app.bot.set_my_commands([
-    BotCommand("start", "Моё приветствие"),
-    BotCommand("help", "Все твои доступные заклинания"),
-    BotCommand("upcoming_events", "Посмотреть грядущие события"),
-    BotCommand("my_points", "Увидеть свои баллы"),
-    BotCommand("my_task", "Посмотреть свои задачи"),
-    BotCommand("get_task", "Взять новую задачу"),
-])
-job_queue = app.job_queue
-job_queue.run_repeating(event_auto_notify, interval=300, first=10)
-app.add_handler(CommandHandler("start", start))
-app.add_handler(CommandHandler("help", help_command))
-app.add_handler(CommandHandler("admin_help", admin_help))
-app.add_handler(CommandHandler("add_event", add_event))
-app.add_handler(CommandHandler("notify", notify))
-app.add_handler(CommandHandler("upcoming_events", upcoming_events))
-app.add_handler(CommandHandler("give_points", give_points))
-app.add_handler(CommandHandler("my_points", my_points))
-app.add_handler(CommandHandler("check_points", check_points))
-app.add_handler(CommandHandler("my_task", my_task))
-app.add_handler(CommandHandler("search_task", search_task))
-app.add_handler(CommandHandler("task_done", task_done))
-app.add_handler(CommandHandler("edit_deadline", edit_deadline))
-app.add_handler(CommandHandler("delete_event", delete_event))
-app.add_handler(CommandHandler("add_task", add_task))
-app.add_handler(CommandHandler("unassign_task", unassign_task))
-app.add_handler(CommandHandler("assign_task", assign_task_to_user))
-app.add_handler(CommandHandler("broadcast", broadcast_message))
-app.add_handler(CommandHandler("show_all_events", show_all_events))
-app.add_handler(CommandHandler("delete_event", delete_event))
-app.add_handler(get_task_handler())
-app.run_polling()
+scheduler = EventScheduler(store, fire_event, WORK_TZ)
+
+
+async def flush_state(context: ContextTypes.DEFAULT_TYPE):
+    await store.flush()
+
+async def compact_ledger(context: ContextTypes.DEFAULT_TYPE):
+    await ledger.compact()
+
+async def report_update_backlog(context: ContextTypes.DEFAULT_TYPE):
+    # Пишем в лог, только если апдейты действительно копятся в очередях чатов
+    stats = update_processor.stats()
+    if stats["backlog"]:
+        logger.info("⏳ Очередь апдейтов: %s", stats)
+
+async def on_shutdown(application):
+    # Недоставленное останется в журнале очереди и уйдёт после перезапуска
+    await outbox.stop()
+    # Дописываем всё, что не успел сбросить периодический flush
+    await store.flush()
+    server = application.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+
+
+async def on_startup(application):
+    await application.bot.set_my_commands([
+        BotCommand("start", "Моё приветствие"),
+        BotCommand("help", "Все твои доступные заклинания"),
+        BotCommand("upcoming_events", "Посмотреть грядущие события"),
+        BotCommand("my_points", "Увидеть свои баллы"),
+        BotCommand("my_task", "Посмотреть свои задачи"),
+        BotCommand("get_task", "Взять новую задачу"),
+    ])
+    outbox.start(application.bot)
+    if METRICS_PORT:
+        # Без метрик бот работает и так — занятый порт не повод не запускаться
+        try:
+            application.bot_data["metrics_server"] = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.warning("⚠️ Метрики не подняты на %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+
+
+def timed(callback):
+    """Оборачивает колбэк хендлера: время и ошибки пишутся в метрики под его именем."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+def instrument(handler):
+    """Включает замер времени для хендлера, а у ConversationHandler — для всех шагов."""
+    if isinstance(handler, ConversationHandler):
+        steps = [*handler.entry_points, *handler.fallbacks]
+        for state_handlers in handler.states.values():
+            steps.extend(state_handlers)
+        for step in steps:
+            instrument(step)
+    else:
+        handler.callback = timed(handler.callback)
+
+
+def build_application(request=None, base_url=None):
+    """
+    request — свой BaseRequest вместо HTTP к Telegram (для бенчмарков),
+    base_url — другой адрес Bot API, например локальный bench/fake_api.py.
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(update_processor)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
+    job_queue = app.job_queue
+    scheduler.start(job_queue)
+    job_queue.run_repeating(flush_state, interval=FLUSH_INTERVAL, first=FLUSH_INTERVAL)
+    job_queue.run_repeating(report_update_backlog, interval=60, first=60)
+    job_queue.run_repeating(compact_ledger, interval=LEDGER_COMPACT_INTERVAL,
+                            first=LEDGER_COMPACT_INTERVAL)
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("admin_help", admin_help))
+    app.add_handler(CommandHandler("add_event", add_event))
+    app.add_handler(CommandHandler("notify", notify))
+    app.add_handler(CommandHandler("upcoming_events", upcoming_events))
+    app.add_handler(CommandHandler("give_points", give_points))
+    app.add_handler(CommandHandler("give_points_bulk", give_points_bulk))
+    app.add_handler(CommandHandler("my_points", my_points))
+    app.add_handler(CommandHandler("check_points", check_points))
+    app.add_handler(CommandHandler("my_task", my_task))
+    app.add_handler(CommandHandler("search_task", search_task))
+    app.add_handler(CommandHandler("task_done", task_done))
+    app.add_handler(CommandHandler("edit_deadline", edit_deadline))
+    app.add_handler(CommandHandler("delete_event", delete_event))
+    app.add_handler(CommandHandler("add_task", add_task))
+    app.add_handler(CommandHandler("unassign_task", unassign_task))
+    app.add_handler(CommandHandler("assign_task", assign_task_to_user))
+    app.add_handler(CommandHandler("broadcast", broadcast_message))
+    app.add_handler(CommandHandler("show_all_events", show_all_events))
+    app.add_handler(CommandHandler("outbox", show_outbox))
+    app.add_handler(CommandHandler("delete_event", delete_event))
+    app.add_handler(CallbackQueryHandler(paginate_listing, pattern=f"^{CALLBACK_PREFIX}\\|"))
+    app.add_handler(get_task_handler())
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            instrument(handler)
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Telegram-бот команды")
+    parser.add_argument(
+        "--mode", choices=("polling", "webhook"), default=os.environ.get("BOT_MODE", "polling"),
+        help="как получать апдейты (по умолчанию BOT_MODE или polling)",
+    )
+    parser.add_argument("--listen", default=os.environ.get("BOT_WEBHOOK_LISTEN", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("BOT_WEBHOOK_PORT", 8443)))
+    parser.add_argument("--url-path", default=os.environ.get("BOT_WEBHOOK_PATH", "telegram"))
+    parser.add_argument(
+        "--webhook-url", default=os.environ.get("BOT_WEBHOOK_URL"),
+        help="публичный адрес за reverse proxy, который регистрируется в Telegram",
+    )
+    parser.add_argument("--secret-token", default=os.environ.get("BOT_WEBHOOK_SECRET"))
+    args = parser.parse_args(argv)
+    if args.mode == "webhook":
+        if not args.webhook_url:
+            parser.error("для webhook нужен --webhook-url или BOT_WEBHOOK_URL")
+        if not args.secret_token:
+            parser.error("для webhook нужен --secret-token или BOT_WEBHOOK_SECRET")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    # Всё состояние (Store, планировщик, очередь отправки, журнал доставок)
+    # живёт в памяти одного процесса. Второй такой процесс, в том числе
+    # второй webhook-воркер за тем же прокси, слал бы каждое напоминание
+    # повторно и затирал бы файлы первого — поэтому он сразу падает.
+    try:
+        instance_lock = acquire_instance_lock(LOCK_FILE)
+    except AlreadyRunningError as e:
+        logger.error("❌ Бот уже запущен: %s", e)
+        raise SystemExit(1)
+    store.load()
+    ledger.load()
+    outbox.load()
+    app = build_application(base_url=BOT_API_URL)
+    if args.mode == "webhook":
+        # Telegram шлёт апдейты на webhook_url, прокси передаёт их сюда.
+        # Воркер один (см. LOCK_FILE), апдейты разных чатов он и так
+        # обрабатывает параллельно — MAX_CONCURRENT_UPDATES.
+        # Запросы без правильного X-Telegram-Bot-Api-Secret-Token
+        # отклоняются с 403 ещё до разбора апдейта.
+        app.run_webhook(
+            listen=args.listen,
+            port=args.port,
+            url_path=args.url_path,
+            webhook_url=args.webhook_url,
+            secret_token=args.secret_token,
+        )
+    else:
+        app.run_polling()
+    instance_lock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Журнал доставленных напоминаний: защита от повторной рассылки.
+
+Ключ — (id события, время события, вид срабатывания, user_id). Время
+входит в ключ, потому что перенесённое событие (или новое, получившее
+id удалённого) — это уже другое напоминание. Outbox смотрит сюда
+перед отправкой и пишет сюда после неё, поэтому если напоминание
+сработало повторно (бот упал до сохранения notified_24h/notified_2h или
+перезапустился посреди рассылки), получат его только те, кому оно ещё
+не ушло.
+
+На диске — append-only файл записей фиксированной длины (29 байт на
+доставку), а не JSON: журнал растёт на каждое отправленное напоминание.
+Записи старше ttl никому не нужны — к этому времени событие давно
+прошло — и выбрасываются при сжатии, которое переписывает файл целиком.
+"""
+import asyncio
+import logging
+import os
+import struct
+import time
+from datetime import timedelta
+
+from storage import write_files_atomic
+
+logger = logging.getLogger(__name__)
+
+# event_id, время события, код вида срабатывания, user_id, когда доставлено (unix time)
+RECORD = struct.Struct("<qqBqI")
+# Вид срабатывания -> код в файле; коды не переиспользовать
+KINDS = {"24h": 1, "2h": 2, "due": 3}
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+
+
+class DeliveryLedger:
+    def __init__(self, path, ttl=timedelta(days=7)):
+        self.path = path
+        self.ttl = ttl.total_seconds()
+        # (event_id, время события, вид, user_id) -> когда доставлено
+        self._seen = {}
+        # Записи, ещё не сброшенные на диск
+        self._buffer = bytearray()
+        self._records_on_disk = 0
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def load(self):
+        """Читает журнал, сразу отбрасывая просроченные записи."""
+        self._seen = {}
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        whole = len(data) - len(data) % RECORD.size
+        if whole != len(data):
+            # Хвост от падения посреди записи
+            logger.warning("⚠️ Обрезана недописанная запись в %s", self.path)
+        expired = time.time() - self.ttl
+        for event_id, event_ts, code, user_id, sent_at in RECORD.iter_unpack(data[:whole]):
+            if sent_at >= expired and code in KIND_NAMES:
+                self._seen[(event_id, event_ts, KIND_NAMES[code], user_id)] = sent_at
+        self._records_on_disk = whole // RECORD.size
+        if self._records_on_disk != len(self._seen) or whole != len(data):
+            write_files_atomic({self.path: self._snapshot()})
+            self._records_on_disk = len(self._seen)
+
+    def seen(self, key) -> bool:
+        return key in self._seen
+
+    def record(self, key):
+        """Отмечает доставку; на диск попадёт при следующем flush()."""
+        if key in self._seen:
+            return
+        event_id, event_ts, kind, user_id = key
+        sent_at = int(time.time())
+        self._seen[key] = sent_at
+        self._buffer += RECORD.pack(event_id, event_ts, KINDS[kind], user_id, sent_at)
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        async with self._lock:
+            chunk, self._buffer = bytes(self._buffer), bytearray()
+            try:
+                await asyncio.to_thread(self._append, chunk)
+            except OSError:
+                self._buffer[:0] = chunk
+                raise
+            self._records_on_disk += len(chunk) // RECORD.size
+
+    def _append(self, chunk):
+        with open(self.path, "ab") as f:
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _snapshot(self) -> bytes:
+        return b"".join(
+            RECORD.pack(event_id, event_ts, KINDS[kind], user_id, sent_at)
+            for (event_id, event_ts, kind, user_id), sent_at in self._seen.items()
+        )
+
+    async def compact(self):
+        """Выбрасывает просроченные записи и переписывает файл, если есть что выбросить."""
+        async with self._lock:
+            expired = time.time() - self.ttl
+            self._seen = {key: sent_at for key, sent_at in self._seen.items() if sent_at >= expired}
+            if not self._buffer and self._records_on_disk == len(self._seen):
+                return
+            before = self._records_on_disk
+            # Несброшенный буфер попадёт в снимок — он уже есть в _seen;
+            # то, что допишут, пока снимок пишется, останется в буфере
+            buffered = len(self._buffer)
+            snapshot = self._snapshot()
+            await asyncio.to_thread(write_files_atomic, {self.path: snapshot})
+            del self._buffer[:buffered]
+            self._records_on_disk = len(snapshot) // RECORD.size
+            logger.info("🧹 Журнал доставок сжат: %d -> %d записей", before, len(self._seen))
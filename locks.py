@@ -0,0 +1,72 @@
+"""
+Именованные asyncio-замки для сериализации изменений задач и участников.
+
+Сами мутации Store синхронные и между собой не пересекаются, но хендлеры
+делают «прочитать — подождать ответа Telegram — записать». Замок по
+ключу ("task", id) / ("user", id) не даёт двум таким цепочкам над одной
+задачей или участником перемешаться при параллельной обработке апдейтов.
+
+Эти замки работают только внутри процесса, как и всё состояние бота
+(Store, планировщик, очередь отправки). Второй процесс над теми же
+файлами не пускает acquire_instance_lock().
+"""
+import asyncio
+import fcntl
+import os
+from contextlib import asynccontextmanager
+
+
+class LockManager:
+    def __init__(self):
+        # ключ -> [замок, сколько корутин его держат или ждут]
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        """
+        Захватывает замки по всем ключам. Порядок захвата фиксирован
+        (по сортировке ключей), поэтому взаимных блокировок не будет.
+        """
+        keys = sorted(set(keys), key=repr)
+        registered, held = [], set()
+        try:
+            for key in keys:
+                entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+                entry[1] += 1
+                registered.append(key)
+                await entry[0].acquire()
+                held.add(key)
+            yield
+        finally:
+            for key in reversed(registered):
+                entry = self._locks[key]
+                if key in held:
+                    entry[0].release()
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+class AlreadyRunningError(RuntimeError):
+    pass
+
+
+def acquire_instance_lock(path):
+    """
+    Берёт эксклюзивный flock на path и возвращает открытый файл — держать
+    его до выхода. Если файл уже заблокирован другим процессом бота над
+    теми же данными, бросает AlreadyRunningError: два процесса слали бы
+    каждое напоминание дважды и затирали бы друг другу файлы.
+    """
+    f = open(path, "a+")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.seek(0)
+        owner = f.read().strip() or "?"
+        f.close()
+        raise AlreadyRunningError(f"{path} уже занят процессом {owner}") from None
+    f.truncate(0)
+    f.write(str(os.getpid()))
+    f.flush()
+    return f
@@ -0,0 +1,53 @@
+"""
+Настройка логирования бота.
+
+Вместо print() модули пишут в logging с уровнем. Одинаковые сообщения
+(один и тот же шаблон из одного места) RateLimitFilter пропускает не
+чаще burst раз за interval секунд, а о выброшенных сообщает в следующей
+пропущенной записи, так что поток однотипных ошибок при сбое рассылки
+не забивает stdout.
+"""
+import logging
+import os
+import time
+
+
+class RateLimitFilter(logging.Filter):
+    # Сколько разных шаблонов помнить, прежде чем забыть неактивные
+    MAX_KEYS = 1000
+
+    def __init__(self, interval=60.0, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        # (файл, строка, шаблон) -> [начало окна, сколько пропущено, сколько выброшено]
+        self._windows = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        key = (record.pathname, record.lineno, record.msg)
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            dropped = window[2] if window else 0
+            if len(self._windows) >= self.MAX_KEYS:
+                self._windows = {
+                    k: w for k, w in self._windows.items() if now - w[0] < self.interval
+                }
+            window = self._windows[key] = [now, 0, 0]
+            if dropped:
+                record.msg = f"{record.msg} (и ещё {dropped} таких же за {self.interval:.0f} с)"
+        if window[1] >= self.burst:
+            window[2] += 1
+            return False
+        window[1] += 1
+        return True
+
+
+def setup_logging(level=None):
+    """Уровень берётся из BOT_LOG_LEVEL (по умолчанию INFO)."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler.addFilter(RateLimitFilter())
+    logging.basicConfig(level=level or os.environ.get("BOT_LOG_LEVEL", "INFO"), handlers=[handler])
+    # httpx пишет по строке INFO на каждый запрос к Bot API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -0,0 +1,201 @@
+"""
+Метрики бота в текстовом формате Prometheus.
+
+Счётчики и гистограммы живут в памяти процесса, а отдаёт их маленький
+HTTP-сервер на asyncio: GET /metrics на локальном порту. Запись метрики —
+это сложение чисел в словаре, без блокировок и ввода-вывода, поэтому её
+можно звать прямо в горячих местах. Инструменты, которые пишут несколько
+модулей, объявлены здесь же, внизу файла.
+"""
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        registry.register(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Gauge:
+    """Значение, которое снимается в момент запроса: fn() -> число."""
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        registry.register(self)
+
+    def samples(self):
+        try:
+            yield f"{self.name} {self.fn()}"
+        except Exception as e:
+            logger.warning("Метрика %s не снялась: %s", self.name, e)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # метки -> [счётчики по корзинам (+Inf последней), сумма]
+        self._series = {}
+        registry.register(self)
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *labels):
+        """with histogram.time("метка"): ... — замеряет длительность блока."""
+        return _Timer(self, labels)
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def samples(self):
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = _labels(self.label_names + ("le",), labels + (bound,))
+                yield f"{self.name}_bucket{le} {cumulative}"
+            plain = _labels(self.label_names, labels)
+            yield f"{self.name}_sum{plain} {total}"
+            yield f"{self.name}_count{plain} {cumulative}"
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+async def _handle(reader, writer, registry):
+    try:
+        request = await reader.readline()
+        # Заголовки запроса нам не нужны, но их надо дочитать
+        while (await reader.readline()).strip():
+            pass
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host="127.0.0.1", port=9100, registry=REGISTRY):
+    """Поднимает HTTP-сервер с /metrics в текущем event loop."""
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle(reader, writer, registry), host, port
+    )
+    logger.info("📈 Метрики: http://%s:%s/metrics", host, port)
+    return server
+
+
+# --- Общие инструменты ---
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Время работы хендлера", labels=("handler",)
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Хендлеры, завершившиеся исключением", labels=("handler",)
+)
+UPDATES = Counter("bot_updates_total", "Обработанные апдейты")
+UPDATE_QUEUE_SECONDS = Histogram(
+    "bot_update_queue_seconds", "Сколько апдейт ждал в очереди своего чата"
+)
+STORAGE_SECONDS = Histogram(
+    "bot_storage_seconds", "Длительность загрузки и сохранения состояния",
+    labels=("operation",),
+)
+STORAGE_BYTES = Counter(
+    "bot_storage_bytes_total", "Объём прочитанного и записанного состояния",
+    labels=("operation",),
+)
+SEND_RESULTS = Counter(
+    "bot_send_total", "Попытки send_message по исходу", labels=("result",)
+)
+JOB_LAG_SECONDS = Histogram(
+    "bot_job_lag_seconds", "Насколько позже плана сработала задача JobQueue",
+    labels=("job",),
+)
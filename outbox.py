@@ -0,0 +1,373 @@
+"""
+Очередь исходящих сообщений, которая переживает перезапуск.
+
+Хендлеры и напоминания не ждут Telegram: они кладут сообщение в Outbox
+и сразу идут дальше, а фоновый воркер отправляет его через Broadcaster
+(с его лимитами и короткими повторами). Если отправка всё-таки не
+удалась, сообщение откладывается с экспоненциальной паузой; после
+max_attempts попыток или при постоянной ошибке (чат не найден, бот
+заблокирован) оно уходит в dead letter — JSONL-файл, который админ
+смотрит командой /outbox.
+
+Очередь хранится в журнале (JSONL): строка add на новое сообщение, done
+на доставленное, retry на отложенное. Поставленное в очередь сразу
+сбрасывается на диск, так что после падения бота напоминания не
+теряются. Отметки о доставке пишутся пачками, поэтому после падения
+сообщение может уйти повторно — но не потеряться. Когда отработанных
+строк в журнале становится много, он переписывается начисто.
+
+Напоминания ставятся в очередь с ключом dedup — (id события, время
+события, вид срабатывания); вместе с chat_id он даёт ключ в
+DeliveryLedger. Такое
+сообщение не ставится, если уже доставлено или ждёт в очереди, и не
+отправляется, если журнал доставок уже знает о нём.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+from collections import deque
+
+from telegram.error import BadRequest, Forbidden
+
+from metrics import Counter
+from storage import write_files_atomic
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_RESULTS = Counter(
+    "bot_outbox_total", "Сообщения очереди отправки по исходу", labels=("result",)
+)
+
+# Ошибки, после которых повторять бессмысленно
+PERMANENT_ERRORS = (BadRequest, Forbidden)
+# Во время большой рассылки отметки о доставке пишутся пачками такого размера
+SYNC_BATCH = 500
+
+
+def _line(record) -> str:
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def _append(path, text, sync=True):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(text)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class Outbox:
+    # Журнал переписывается, когда отработанных строк больше этого
+    # и больше, чем живых сообщений
+    COMPACT_AFTER = 10000
+
+    def __init__(self, path, dead_path, broadcaster, ledger=None, max_attempts=8,
+                 backoff=5.0, max_backoff=3600.0, concurrency=10):
+        self.path = path
+        self.dead_path = dead_path
+        self.broadcaster = broadcaster
+        self.ledger = ledger
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.concurrency = concurrency
+        # id -> {"id", "chat_id", "text", "kwargs", "attempts", "due"[, "key"]}
+        self._items = {}
+        # Ключи ledger у сообщений, которые сейчас в очереди
+        self._pending_keys = set()
+        # (due, id); записи с устаревшим due пропускаются при извлечении
+        self._heap = []
+        self._ids = itertools.count(1)
+        # Отметки done/retry и dead letters, ещё не записанные на диск
+        self._records = []
+        self._dead = []
+        self._garbage = 0
+        self._io_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self._deliveries = set()
+        self.delivered = 0
+        self.dead = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    # --- Загрузка ---
+
+    def load(self):
+        """Восстанавливает очередь из журнала. Отсутствующий журнал — пустая очередь."""
+        self._items = {}
+        lines = 0
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for lines, raw in enumerate(f, 1):
+                    try:
+                        record = json.loads(raw)
+                    except ValueError:
+                        # Недописанная строка от падения посреди записи
+                        logger.warning("⚠️ Пропущена битая строка %d в %s", lines, self.path)
+                        continue
+                    op = record.pop("op")
+                    if op == "add":
+                        self._items[record["id"]] = record
+                    elif op == "retry" and record["id"] in self._items:
+                        self._items[record["id"]].update(record)
+                    elif op == "done":
+                        self._items.pop(record["id"], None)
+        except FileNotFoundError:
+            pass
+        self._heap = [(item["due"], item_id) for item_id, item in self._items.items()]
+        self._pending_keys = {tuple(item["key"]) for item in self._items.values() if "key" in item}
+        heapq.heapify(self._heap)
+        self._ids = itertools.count(max(self._items, default=0) + 1)
+        self._garbage = lines - len(self._items)
+        self.dead = self._count_dead()
+        if self._items:
+            logger.info("📨 В очереди отправки %d сообщений с прошлого запуска", len(self._items))
+
+    def _count_dead(self):
+        try:
+            with open(self.dead_path, encoding="utf-8") as f:
+                return sum(1 for _ in f)
+        except FileNotFoundError:
+            return 0
+
+    # --- Постановка в очередь ---
+
+    async def enqueue(self, chat_id, text, **kwargs):
+        """Ставит сообщение в очередь; возвращается, когда оно уже на диске."""
+        return await self.fan_out([chat_id], text, **kwargs)
+
+    async def fan_out(self, chat_ids, text, dedup=None, **kwargs):
+        """
+        Ставит text в очередь для каждого chat_ids. С dedup=(id события,
+        время события, вид) пропускает тех, кому это уже доставлено или стоит в очереди.
+        Возвращает число поставленных сообщений.
+        """
+        messages = [
+            (chat_id, text, kwargs, (*dedup, chat_id) if dedup else None)
+            for chat_id in dict.fromkeys(chat_ids)
+        ]
+        async with self._io_lock:
+            return await self._put(messages)
+
+    def _delivered(self, key):
+        return self.ledger is not None and self.ledger.seen(key)
+
+    def _is_duplicate(self, key, batch):
+        """Ключ уже доставлен, ждёт в очереди или встретился раньше в той же пачке (batch)."""
+        return key in batch or key in self._pending_keys or self._delivered(key)
+
+    async def _put(self, messages):
+        """
+        Пишет [(chat_id, text, kwargs, key)] в журнал и в очередь, пропуская
+        ключи, которые уже доставлены или ждут в очереди. Вызывается под
+        _io_lock: проверка и постановка не должны разрываться ожиданием
+        записи другого вызова, иначе одно напоминание встанет дважды.
+        """
+        now = time.time()
+        items = []
+        keys = set()
+        for chat_id, text, kwargs, key in messages:
+            item = {"id": next(self._ids), "chat_id": chat_id, "text": text,
+                    "kwargs": kwargs, "attempts": 0, "due": now}
+            if key:
+                key = tuple(key)
+                if self._is_duplicate(key, keys):
+                    continue
+                keys.add(key)
+                item["key"] = list(key)
+            items.append(item)
+        if not items:
+            return 0
+        payload = "".join(_line({"op": "add", **item}) for item in items)
+        await asyncio.to_thread(_append, self.path, payload)
+        for item in items:
+            self._items[item["id"]] = item
+            heapq.heappush(self._heap, (now, item["id"]))
+            if "key" in item:
+                self._pending_keys.add(tuple(item["key"]))
+        OUTBOX_RESULTS.inc("queued", amount=len(items))
+        self._wakeup.set()
+        return len(items)
+
+    # --- Воркер ---
+
+    def start(self, bot):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        """Останавливает воркер и дописывает отметки; недоставленное останется в журнале."""
+        tasks = [*self._deliveries, self._worker] if self._worker else list(self._deliveries)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker = None
+        await self._sync()
+
+    async def _run(self, bot):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            self._wakeup.clear()
+            while self._heap and self._heap[0][0] <= time.time():
+                due, item_id = heapq.heappop(self._heap)
+                item = self._items.get(item_id)
+                if item is None or item["due"] != due:
+                    continue
+                await semaphore.acquire()
+                task = asyncio.create_task(self._deliver(bot, item))
+                self._deliveries.add(task)
+                task.add_done_callback(self._deliveries.discard)
+                task.add_done_callback(lambda _: semaphore.release())
+                if len(self._records) >= SYNC_BATCH:
+                    await self._sync_logged()
+            await self._sync_logged()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, bot, item):
+        key = tuple(item["key"]) if "key" in item else None
+        if key and self._delivered(key):
+            # Уже ушло до перезапуска, но отметка done не успела на диск
+            self._finish(item)
+            OUTBOX_RESULTS.inc("duplicate")
+            self._wakeup.set()
+            return
+        try:
+            await self.broadcaster.send(bot, item["chat_id"], item["text"], **item["kwargs"])
+        except PERMANENT_ERRORS as e:
+            self._bury(item, e)
+        except Exception as e:
+            item["attempts"] += 1
+            if item["attempts"] >= self.max_attempts:
+                self._bury(item, e)
+            else:
+                delay = min(self.max_backoff, self.backoff * 2 ** (item["attempts"] - 1))
+                item["due"] = time.time() + delay
+                heapq.heappush(self._heap, (item["due"], item["id"]))
+                self._records.append(
+                    {"op": "retry", "id": item["id"], "attempts": item["attempts"], "due": item["due"]}
+                )
+                OUTBOX_RESULTS.inc("retry")
+                logger.info("🔁 Сообщение в %s отложено на %.0f с: %s", item["chat_id"], delay, e)
+        else:
+            if key and self.ledger is not None:
+                self.ledger.record(key)
+            self._finish(item)
+            self.delivered += 1
+            OUTBOX_RESULTS.inc("delivered")
+        self._wakeup.set()
+
+    def _finish(self, item):
+        del self._items[item["id"]]
+        if "key" in item:
+            self._pending_keys.discard(tuple(item["key"]))
+        self._records.append({"op": "done", "id": item["id"]})
+
+    def _bury(self, item, error):
+        self._finish(item)
+        self._dead.append({
+            "chat_id": item["chat_id"], "text": item["text"], "kwargs": item["kwargs"],
+            "key": item.get("key"), "attempts": item["attempts"], "error": str(error),
+            "failed_at": int(time.time()),
+        })
+        self.dead += 1
+        OUTBOX_RESULTS.inc("dead")
+        logger.warning("☠️ Сообщение в %s ушло в dead letter: %s", item["chat_id"], error)
+
+    async def _sync_logged(self):
+        try:
+            await self._sync()
+        except OSError as e:
+            # Отметки остались в памяти — допишем их в следующий раз
+            logger.error("❌ Не удалось записать журнал очереди: %s", e)
+
+    async def _sync(self):
+        """Дописывает накопленные отметки, а при необходимости сжимает журнал."""
+        if not self._records and not self._dead:
+            return
+        async with self._io_lock:
+            records, self._records = self._records, []
+            dead, self._dead = self._dead, []
+            try:
+                # Сначала журнал доставок: если упадём до отметки done,
+                # после перезапуска сообщение не уйдёт повторно
+                if self.ledger is not None:
+                    await self.ledger.flush()
+                # Dead letter — раньше отметки в журнале, чтобы не потерять сообщение между ними
+                if dead:
+                    await asyncio.to_thread(_append, self.dead_path, "".join(map(_line, dead)))
+                    dead = []
+                await self._write_records(records)
+            except OSError:
+                self._records[:0] = records
+                self._dead[:0] = dead
+                raise
+
+    async def _write_records(self, records):
+        if not records:
+            return
+        # done отменяет и себя, и свою строку add; retry — только себя
+        garbage = self._garbage + sum(2 if r["op"] == "done" else 1 for r in records)
+        if garbage > max(self.COMPACT_AFTER, len(self._items)):
+            snapshot = "".join(_line({"op": "add", **item}) for item in self._items.values())
+            await asyncio.to_thread(write_files_atomic, {self.path: snapshot})
+            self._garbage = 0
+        else:
+            await asyncio.to_thread(_append, self.path, "".join(map(_line, records)), False)
+            self._garbage = garbage
+
+    # --- Для админа ---
+
+    def stats(self):
+        return {
+            "pending": len(self._items),
+            "sending": len(self._deliveries),
+            "delivered": self.delivered,
+            "dead": self.dead,
+        }
+
+    def dead_letters(self, limit=5):
+        """Последние limit сообщений из dead letter, новые в конце."""
+        try:
+            with open(self.dead_path, encoding="utf-8") as f:
+                return [json.loads(raw) for raw in deque(f, maxlen=limit)]
+        except FileNotFoundError:
+            return []
+
+    async def requeue_dead(self):
+        """
+        Возвращает dead letters в очередь. Письма, чьё напоминание уже
+        доставлено или снова ждёт в очереди, не ставятся второй раз и
+        остаются в файле. Возвращает (поставлено, осталось).
+        """
+        async with self._io_lock:
+            try:
+                with open(self.dead_path, encoding="utf-8") as f:
+                    letters = [json.loads(raw) for raw in f]
+            except FileNotFoundError:
+                return 0, 0
+            fresh, kept, keys = [], [], set()
+            for letter in letters:
+                key = tuple(letter["key"]) if letter.get("key") else None
+                if key and self._is_duplicate(key, keys):
+                    kept.append(letter)
+                    continue
+                if key:
+                    keys.add(key)
+                fresh.append((letter["chat_id"], letter["text"], letter["kwargs"], key))
+            count = await self._put(fresh)
+            await asyncio.to_thread(
+                write_files_atomic, {self.dead_path: "".join(_line(letter) for letter in kept)}
+            )
+            # Ещё не записанные dead letters остаются до следующего _sync
+            self.dead = len(kept) + len(self._dead)
+        return count, len(kept)
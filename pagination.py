@@ -0,0 +1,119 @@
+"""
+Постраничный просмотр длинных админских списков.
+
+Вместо того чтобы слать весь список, бот отправляет одно сообщение
+со страницей и кнопками «назад/вперёд», а по нажатию редактирует его
+на месте. Страницы берутся из отсортированного снимка коллекции
+(SortedView), который пересобирается только после изменений в Store.
+Курсор в callback_data — ключ сортировки первой карточки страницы,
+поэтому листание не сбивается, если между нажатиями что-то добавили
+или удалили.
+"""
+from bisect import bisect_left
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from templates import MAX_MESSAGE_LEN, chunk_cards, message_len
+
+# Префикс callback_data кнопок листания
+CALLBACK_PREFIX = "pg"
+PAGE_SIZE = 10
+
+
+class SortedView:
+    def __init__(self, store, kind, source, key):
+        """
+        source() отдаёт записи коллекции, key(запись) — ключ сортировки
+        вида (число, id), например (epoch даты, id). Снимок сбрасывается при изменении записей kind.
+        """
+        self.source = source
+        self.key = key
+        self._items = None
+        self._keys = None
+        store.subscribe(lambda changed, _: self._invalidate(changed, kind))
+
+    def _invalidate(self, changed, kind):
+        if changed == kind:
+            self._items = self._keys = None
+
+    def _build(self):
+        if self._items is None:
+            self._items = sorted(self.source(), key=self.key)
+            self._keys = [self.key(item) for item in self._items]
+
+    def __len__(self):
+        self._build()
+        return len(self._items)
+
+    def position(self, cursor):
+        """Позиция первой записи с ключом не меньше cursor (None — начало)."""
+        self._build()
+        return 0 if cursor is None else bisect_left(self._keys, cursor)
+
+    def slice(self, start, stop):
+        self._build()
+        return self._items[start:stop]
+
+    def key_at(self, position):
+        self._build()
+        return self._keys[position]
+
+
+def encode_cursor(view_name, key):
+    field, entity_id = key
+    return f"{CALLBACK_PREFIX}|{view_name}|{field}|{entity_id}"
+
+
+def decode_cursor(data):
+    """callback_data -> (имя снимка, ключ) или None, если это не наша кнопка."""
+    parts = data.split("|")
+    if len(parts) != 4 or parts[0] != CALLBACK_PREFIX:
+        return None
+    try:
+        return parts[1], (int(parts[2]), int(parts[3]))
+    except ValueError:
+        return None
+
+
+def build_page(view_name, view, cursor, title, render, page_size=PAGE_SIZE,
+               limit=MAX_MESSAGE_LEN):
+    """
+    Рендерит страницу, начиная с cursor. Возвращает (текст, клавиатура
+    или None, если всё влезло в одну страницу). В страницу попадает
+    не больше page_size карточек и не больше limit символов.
+    """
+    total = len(view)
+    start = min(view.position(cursor), max(total - 1, 0))
+    items = view.slice(start, start + page_size)
+
+    # Запас под строку «1–10 из 57»
+    budget = limit - message_len(title) - 32
+    cards, size = [], 0
+    for item in items:
+        card = render(item)
+        card_size = message_len(card)
+        if cards and size + card_size > budget:
+            break
+        cards.append(card)
+        size += card_size
+    end = start + len(cards)
+
+    footer = f"\n{start + 1}–{end} из {total}" if total > end - start else ""
+    if size > budget:
+        # Одна карточка больше лимита — показываем её начало
+        text = next(chunk_cards(title, cards, budget))
+    else:
+        text = (title + "".join(cards)).strip()
+    text += footer
+
+    buttons = []
+    if start > 0:
+        prev_start = max(start - page_size, 0)
+        buttons.append(InlineKeyboardButton(
+            "⬅️ Назад", callback_data=encode_cursor(view_name, view.key_at(prev_start))
+        ))
+    if end < total:
+        buttons.append(InlineKeyboardButton(
+            "Вперёд ➡️", callback_data=encode_cursor(view_name, view.key_at(end))
+        ))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
@@ -0,0 +1,89 @@
+"""
+Параллельная обработка апдейтов с сохранением порядка внутри чата.
+
+Апдейты разных чатов обрабатываются одновременно (не больше
+max_concurrent_updates чатов за раз), а апдейты одного чата — строго
+по очереди, в порядке поступления. Это важно для ConversationHandler
+в /get_task: ответы «проект → номер задачи → да» не должны обгонять
+друг друга.
+"""
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import UPDATE_QUEUE_SECONDS, UPDATES
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> очередь (корутина, когда встала в очередь) за текущим апдейтом чата
+        self._queues = {}
+        # Метрики для наблюдения за нагрузкой
+        self.processed = 0
+        self.backlog = 0
+        self.max_backlog = 0
+        self.queue_wait_total = 0.0
+
+    @staticmethod
+    def _chat_id(update):
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = self._chat_id(update)
+        if chat_id is None:
+            await self._run(coroutine)
+            return
+
+        queue = self._queues.get(chat_id)
+        if queue is not None:
+            # Чат уже обрабатывается: встаём в его очередь и сразу отдаём
+            # слот другим чатам — апдейт выполнит тот, кто держит чат.
+            queue.append((coroutine, time.monotonic()))
+            self.backlog += 1
+            self.max_backlog = max(self.max_backlog, self.backlog)
+            return
+
+        queue = self._queues[chat_id] = deque()
+        try:
+            await self._run(coroutine)
+            while queue:
+                coroutine, queued_at = queue.popleft()
+                self.backlog -= 1
+                waited = time.monotonic() - queued_at
+                self.queue_wait_total += waited
+                UPDATE_QUEUE_SECONDS.observe(waited)
+                await self._run(coroutine)
+        finally:
+            del self._queues[chat_id]
+            # Если нас отменили посреди очереди — не оставляем висящих корутин
+            for coroutine, _ in queue:
+                coroutine.close()
+                self.backlog -= 1
+
+    async def _run(self, coroutine):
+        try:
+            await coroutine
+        finally:
+            self.processed += 1
+            UPDATES.inc()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrent_updates": self.max_concurrent_updates,
+            "active_chats": len(self._queues),
+            "backlog": self.backlog,
+            "max_backlog": self.max_backlog,
+            "processed": self.processed,
+            "queue_wait_total": round(self.queue_wait_total, 3),
+        }
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,149 @@
+"""
+Планировщик напоминаний и истечения событий.
+
+Вместо периодического опроса всех событий держим кучу (heapq) ближайших
+срабатываний: напоминание за 24 часа, за 2 часа и наступление события.
+В JobQueue всегда стоит ровно одна задача — на самое раннее срабатывание.
+При изменении события старые записи в куче не ищем, а помечаем
+устаревшими через номер версии события и пропускаем при извлечении.
+"""
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime, timedelta
+
+from metrics import JOB_LAG_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Вид срабатывания -> (за сколько до события, сколько можно опоздать)
+# Допуск нужен, чтобы после простоя бота догнать ещё актуальные
+# напоминания, но не слать «за 24 часа» за час до начала.
+REMINDERS = {
+    "24h": (timedelta(hours=24), timedelta(hours=1)),
+    "2h": (timedelta(hours=2), timedelta(minutes=30)),
+}
+DUE = "due"
+
+
+class EventScheduler:
+    def __init__(self, store, fire, tz):
+        """
+        fire — корутина fire(context, event, kind), которая выполняет
+        само срабатывание; kind — ключ из REMINDERS или DUE.
+        """
+        self.store = store
+        self.fire = fire
+        self.tz = tz
+        self.job_queue = None
+        self._heap = []
+        self._versions = {}
+        self._seq = itertools.count()
+        self._job = None
+        self._job_at = None
+        store.subscribe(self._on_change)
+
+    def start(self, job_queue):
+        self.job_queue = job_queue
+        self._heap = []
+        self._versions = {}
+        for event in list(self.store.events):
+            self._push(event)
+        self._arm()
+
+    def _on_change(self, kind, entity_id):
+        # После полной перезагрузки Store планировщик перезапускают через start()
+        if kind == "event" and entity_id is not None:
+            self.reschedule(entity_id)
+
+    def reschedule(self, event_id):
+        """Перепланирует срабатывания события после его добавления, правки или удаления."""
+        self._versions[event_id] = self._versions.get(event_id, 0) + 1
+        event = self.store.get_event(event_id)
+        if event is None:
+            self._versions.pop(event_id)
+        else:
+            self._push(event)
+        self._compact()
+        self._arm()
+
+    def _push(self, event):
+        if not event.get("notify_users"):
+            return
+        moment = self.store.event_time(event["id"])
+        if moment is None:
+            logger.warning("❌ Не удалось запланировать событие #%s: дата %r", event["id"], event.get("datetime"))
+            return
+        dt = moment.dt
+        now = datetime.now(self.tz)
+        version = self._versions.setdefault(event["id"], 0)
+
+        for kind, (before, grace) in REMINDERS.items():
+            if event.get(f"notified_{kind}"):
+                continue
+            at = dt - before
+            if at + grace < now:
+                continue
+            self._heappush(at, event["id"], kind, version)
+        self._heappush(dt, event["id"], DUE, version)
+
+    def _heappush(self, at, event_id, kind, version):
+        heapq.heappush(self._heap, (at.timestamp(), next(self._seq), event_id, kind, version))
+
+    def _is_stale(self, entry):
+        return self._versions.get(entry[2]) != entry[4]
+
+    def _compact(self):
+        # У каждого события не больше трёх живых записей. Если куча сильно
+        # больше — в ней в основном мусор, пересобираем её целиком.
+        if len(self._heap) > 6 * len(self._versions) + 16:
+            self._heap = [entry for entry in self._heap if not self._is_stale(entry)]
+            heapq.heapify(self._heap)
+
+    def _arm(self):
+        while self._heap and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+        if self.job_queue is None:
+            return
+        at = self._heap[0][0] if self._heap else None
+        if at == self._job_at:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        self._job_at = at
+        if at is not None:
+            # Просроченное срабатывание (после простоя или долгого _run)
+            # ставим на «сейчас»: у APScheduler допуск на опоздание всего
+            # секунда, и пропущенная задача молча выбрасывается — а с ней
+            # и все следующие срабатывания, ведь _job_at уже равен at.
+            # Поэтому и допуск снимаем: опоздавшие сами решают в _push/fire.
+            when = datetime.fromtimestamp(max(at, time.time()), self.tz)
+            self._job = self.job_queue.run_once(
+                self._run, when=when, name="event_scheduler",
+                job_kwargs={"misfire_grace_time": None},
+            )
+
+    async def _run(self, context):
+        self._job = None
+        self._job_at = None
+        now = datetime.now(self.tz).timestamp()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if not self._is_stale(entry):
+                due.append(entry)
+        if due:
+            # Насколько JobQueue опоздала относительно самого раннего срабатывания
+            JOB_LAG_SECONDS.observe(max(now - due[0][0], 0), "event_scheduler")
+
+        for _, _, event_id, kind, _ in due:
+            event = self.store.get_event(event_id)
+            if event is None:
+                continue
+            try:
+                await self.fire(context, event, kind)
+            except Exception as e:
+                logger.exception("❌ Ошибка срабатывания события #%s (%s): %s", event_id, kind, e)
+        self._arm()
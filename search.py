@@ -0,0 +1,134 @@
+"""
+Полнотекстовый поиск задач для /search_task.
+
+Обратный индекс: нормализованный токен -> {id задачи: вес}. Слова из
+названия весят больше, чем из проекта и типа, а те — больше, чем из
+описания. Нормализация грубая, но для русского её хватает: casefold,
+ё -> е и отрезание типичных окончаний, чтобы «механики», «механика» и
+«механик» сводились к одному токену. Индекс обновляется по одной
+задаче через подписку на Store.
+"""
+import heapq
+import math
+import re
+from functools import lru_cache
+
+FIELD_WEIGHTS = {"title": 3, "project": 2, "type": 2, "description": 1}
+
+_WORD = re.compile(r"\w+")
+
+# Отрезаем самое длинное подошедшее окончание, если после него
+# остаётся хотя бы MIN_STEM букв
+_ENDINGS = frozenset((
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими",
+    "ией", "ать", "ять", "ить", "еть", "ешь", "ишь", "ует", "ют", "ут",
+    "ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ой", "ей", "ую", "юю",
+    "ом", "ем", "ам", "ям", "ах", "ях", "ов", "ев", "ью", "ия", "ии",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+    "ing", "es", "s",
+))
+_ENDING_LENGTHS = sorted({len(ending) for ending in _ENDINGS}, reverse=True)
+MIN_STEM = 4
+
+
+@lru_cache(maxsize=65536)
+def normalize(word: str) -> str:
+    word = word.casefold().replace("ё", "е")
+    for length in _ENDING_LENGTHS:
+        if len(word) - length >= MIN_STEM and word[-length:] in _ENDINGS:
+            return word[:-length]
+    return word
+
+
+def tokenize(text) -> list:
+    return [normalize(word) for word in _WORD.findall(str(text or ""))]
+
+
+class TaskSearchIndex:
+    def __init__(self, store):
+        self.store = store
+        # токен -> {id задачи: вес}
+        self._postings = {}
+        # id задачи -> {токен: вес}, чтобы при изменении убрать старые токены
+        self._docs = {}
+        self._built = False
+        store.subscribe(self._on_change)
+
+    def _on_change(self, kind, entity_id):
+        if kind != "task":
+            return
+        if entity_id is None:
+            # Store перечитан целиком — пересоберём при следующем поиске
+            self._built = False
+        elif self._built:
+            self._remove(entity_id)
+            task = self.store.get_task(entity_id)
+            if task is not None:
+                self._add(task)
+
+    def _build(self):
+        self._postings = {}
+        self._docs = {}
+        for task in self.store.tasks:
+            self._add(task)
+        self._built = True
+
+    def _add(self, task):
+        weights = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(task.get(field)):
+                weights[token] = weights.get(token, 0) + weight
+        self._docs[task["id"]] = weights
+        for token, weight in weights.items():
+            self._postings.setdefault(token, {})[task["id"]] = weight
+
+    def _remove(self, task_id):
+        for token in self._docs.pop(task_id, {}):
+            posting = self._postings[token]
+            posting.pop(task_id, None)
+            if not posting:
+                del self._postings[token]
+
+    def search(self, query, limit=None):
+        """
+        Задачи, в которых есть все слова запроса, по убыванию релевантности
+        (вес поля × редкость слова). Если таких нет — хотя бы с одним словом.
+        """
+        return [self.store.get_task(task_id) for task_id in self.search_ids(query, limit)]
+
+    def search_ids(self, query, limit=None):
+        """То же, что search(), но id задач — чтобы взять записи из снимка."""
+        if not self._built:
+            self._build()
+        tokens = list(dict.fromkeys(tokenize(query)))
+        postings = [self._postings.get(token, {}) for token in tokens]
+        if not postings:
+            return []
+
+        # Пересечение начинаем с самого короткого списка
+        matched = set(min(postings, key=len))
+        for posting in postings:
+            matched.intersection_update(posting)
+        if not matched:
+            matched = set().union(*postings)
+
+        total = len(self._docs)
+        scores = dict.fromkeys(matched, 0)
+        for posting in postings:
+            if not posting:
+                continue
+            idf = math.log(1 + total / len(posting))
+            # Идём по меньшему из двух множеств
+            if len(posting) < len(scores):
+                for task_id, weight in posting.items():
+                    if task_id in scores:
+                        scores[task_id] += weight * idf
+            else:
+                for task_id in scores:
+                    scores[task_id] += posting.get(task_id, 0) * idf
+
+        def rank(task_id):
+            return -scores[task_id], task_id
+        if limit is None:
+            return sorted(scores, key=rank)
+        return heapq.nsmallest(limit, scores, key=rank)
@@ -0,0 +1,150 @@
+"""
+Рассылка сообщений с ограничением скорости.
+
+Telegram режет бота при превышении ~30 сообщений в секунду суммарно и
+~1 сообщения в секунду в один чат. Broadcaster держит общий token bucket
+и по одному на чат и повторяет отправку при RetryAfter и сетевых сбоях.
+Массовые рассылки идут через outbox.Outbox, который сам решает, сколько
+сообщений слать параллельно, и отправляет каждое через send().
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from metrics import SEND_RESULTS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket без блокировок: acquire() резервирует токен сразу, даже
+    в долг, и спит ровно столько, сколько нужно, чтобы долг погасился.
+    Благодаря этому конкурентные вызовы выстраиваются в очередь сами.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    async def acquire(self):
+        self._refill()
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+    def pause(self, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд (после flood wait)."""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+@dataclass
+class BroadcastReport:
+    total: int = 0
+    success: int = 0
+    retries: int = 0
+    # chat_id -> текст последней ошибки
+    errors: dict = field(default_factory=dict)
+
+    @property
+    def failed(self) -> int:
+        return len(self.errors)
+
+
+class Broadcaster:
+    # Сколько per-chat ведер держать, прежде чем выкидывать неактивные
+    MAX_CHAT_BUCKETS = 1000
+
+    def __init__(self, global_rate: float = 25, per_chat_rate: float = 1,
+                 max_retries: int = 3, backoff: float = 1.0):
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._chat_buckets = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self._chat_buckets = {
+                    cid: b for cid, b in self._chat_buckets.items() if not b.full
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+        return bucket
+
+    async def send(self, bot, chat_id, text, report: BroadcastReport = None, **kwargs):
+        """
+        Отправляет одно сообщение с учётом лимитов и повторов.
+        Возвращает отправленное сообщение; ошибку, если попытки кончились,
+        пробрасывает наружу.
+        """
+        attempt = 0
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                message = await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                SEND_RESULTS.inc("ok")
+                return message
+            except RetryAfter as e:
+                # Flood wait касается всего бота, поэтому тормозим всех;
+                # ждать будем уже внутри global_bucket.acquire()
+                SEND_RESULTS.inc("retry_after")
+                error, delay = e, 0
+                self.global_bucket.pause(e.retry_after)
+            except BadRequest:
+                SEND_RESULTS.inc("bad_request")
+                raise
+            except Forbidden:
+                # Бот заблокирован или выгнан из чата — повторять бесполезно
+                SEND_RESULTS.inc("forbidden")
+                raise
+            except NetworkError as e:
+                SEND_RESULTS.inc("network_error")
+                error, delay = e, self.backoff * 2 ** attempt
+            except TelegramError:
+                SEND_RESULTS.inc("error")
+                raise
+            attempt += 1
+            if attempt > self.max_retries:
+                SEND_RESULTS.inc("gave_up")
+                raise error
+            if report is not None:
+                report.retries += 1
+            await asyncio.sleep(delay)
+
+    async def send_parts(self, bot, chat_id, parts, **kwargs) -> BroadcastReport:
+        """
+        Отправляет части длинного сообщения в один чат строго по порядку,
+        с теми же лимитами и повторами, что и send(). parts может быть
+        генератором — следующая часть собирается, пока ждём отправки.
+        Сбой одной части не мешает остальным; в report.errors попадают
+        номера неотправленных частей.
+        """
+        report = BroadcastReport()
+        for index, part in enumerate(parts):
+            report.total += 1
+            try:
+                await self.send(bot, chat_id, part, report=report, **kwargs)
+                report.success += 1
+            except Exception as e:
+                report.errors[index] = str(e)
+                logger.warning("❌ Не удалось отправить часть %d в %s: %s", index + 1, chat_id, e)
+        return report
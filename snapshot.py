@@ -0,0 +1,183 @@
+"""
+Неизменяемые снимки данных Store для хендлеров, которые только читают.
+
+Store меняет записи на месте, поэтому хендлер, который читает данные
+и между делом ждёт Telegram (например, шлёт длинный список частями),
+может увидеть полуизменённое состояние. Снимок — это версия коллекций,
+которая после публикации больше не меняется: читатель берёт текущий
+снимок одним вызовом, без блокировок и копий, и спокойно держит его
+сколько угодно await'ов.
+
+Чтобы публикация не копировала весь набор данных, коллекции снимка —
+PersistentMap: записи разложены по корзинам по хешу ключа, и новая
+версия копирует только корзины с изменившимися записями, а остальные
+делит с предыдущей. Сами изменившиеся записи копируются (с вложенными
+словарями и списками), поэтому живые записи Store можно дальше менять
+на месте. Сколько бы читателей ни держали снимки, в памяти лежат
+только разные версии корзин, а не копия данных на каждый запрос.
+
+В копию записи добавляются два производных поля: MOMENT — уже
+разобранная Store дата (дедлайн задачи, время события), чтобы списки
+сортировали и показывали одну и ту же дату без повторного разбора, и
+VERSION — номер снимка, в котором эта версия записи появилась.
+"""
+from collections.abc import Mapping
+
+# Сколько записей в среднем держать в корзине
+BUCKET_SIZE = 32
+# Значение в updated(): удалить ключ
+REMOVED = object()
+# Производные поля записей снимка: Moment даты (или None) и номер версии
+MOMENT = "_moment"
+VERSION = "_version"
+
+
+def freeze(record, version, moment=None):
+    """Копия записи, не разделяющая с оригиналом вложенные словари и списки."""
+    frozen = {
+        key: value.copy() if isinstance(value, (dict, list)) else value
+        for key, value in record.items()
+    }
+    frozen[VERSION] = version
+    frozen[MOMENT] = moment
+    return frozen
+
+
+class PersistentMap(Mapping):
+    """Неизменяемый словарь с разделяемыми между версиями корзинами."""
+
+    __slots__ = ("_buckets", "_mask", "_len")
+
+    def __init__(self, items=(), _buckets=None, _len=0):
+        if _buckets is not None:
+            self._buckets, self._len = _buckets, _len
+        else:
+            items = dict(items)
+            size = 1
+            while size * BUCKET_SIZE < len(items):
+                size *= 2
+            self._buckets = [{} for _ in range(size)]
+            self._len = len(items)
+            for key, value in items.items():
+                self._buckets[hash(key) & (size - 1)][key] = value
+        self._mask = len(self._buckets) - 1
+
+    def _bucket(self, key):
+        return self._buckets[hash(key) & self._mask]
+
+    def __getitem__(self, key):
+        return self._bucket(key)[key]
+
+    def get(self, key, default=None):
+        return self._bucket(key).get(key, default)
+
+    def __contains__(self, key):
+        return key in self._bucket(key)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for bucket in self._buckets:
+            yield from bucket
+
+    def values(self):
+        for bucket in self._buckets:
+            yield from bucket.values()
+
+    def updated(self, changes):
+        """
+        Новая версия с изменениями {ключ: значение или REMOVED}. Копируются
+        только затронутые корзины; если записей стало слишком много для
+        текущего числа корзин, словарь перестраивается целиком.
+        """
+        buckets = list(self._buckets)
+        copied = set()
+        size = self._len
+        for key, value in changes.items():
+            index = hash(key) & self._mask
+            if index not in copied:
+                buckets[index] = dict(buckets[index])
+                copied.add(index)
+            bucket = buckets[index]
+            if value is REMOVED:
+                if bucket.pop(key, REMOVED) is not REMOVED:
+                    size -= 1
+            else:
+                if key not in bucket:
+                    size += 1
+                bucket[key] = value
+        result = PersistentMap(_buckets=buckets, _len=size)
+        if size > 4 * BUCKET_SIZE * len(buckets):
+            return PersistentMap(result.items())
+        return result
+
+
+class Snapshot:
+    """Версия участников, задач и событий. Записи не менять."""
+
+    __slots__ = ("version", "users", "tasks", "events", "_usernames")
+
+    def __init__(self, version, users, tasks, events, usernames):
+        self.version = version
+        self.users = users
+        self.tasks = tasks
+        self.events = events
+        self._usernames = usernames
+
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    def find_user(self, username):
+        """Ищет участника по username без учёта регистра и ведущего @."""
+        user_id = self._usernames.get(username.lstrip("@").casefold())
+        return None if user_id is None else self.users.get(user_id)
+
+    def get_task(self, task_id):
+        return self.tasks.get(task_id)
+
+    def get_event(self, event_id):
+        return self.events.get(event_id)
+
+
+def next_snapshot(previous, version, live, stale, moments):
+    """
+    Следующий снимок: live — {"users": {...}, "tasks": {...}, "events": {...}}
+    живых записей, stale — {коллекция: id изменённых записей или None},
+    moments — {коллекция: функция id -> Moment} для коллекций с датой.
+    Коллекция с None пересобирается целиком — так из EMPTY получается
+    первый снимок.
+    """
+    maps = {"users": previous.users, "tasks": previous.tasks, "events": previous.events}
+    usernames = previous._usernames
+    name_changes = {}
+    for name, ids in stale.items():
+        records = live[name]
+        moment = moments.get(name, lambda key: None)
+        if ids is None:
+            maps[name] = PersistentMap(
+                (key, freeze(record, version, moment(key))) for key, record in records.items()
+            )
+            if name == "users":
+                usernames = PersistentMap(
+                    (user["username"].casefold(), user_id)
+                    for user_id, user in records.items() if user.get("username")
+                )
+            continue
+        changes = {}
+        for key in ids:
+            record = records.get(key)
+            changes[key] = REMOVED if record is None else freeze(record, version, moment(key))
+            if name == "users":
+                old = previous.users.get(key)
+                if old is not None and old.get("username"):
+                    name_changes[old["username"].casefold()] = REMOVED
+                if record is not None and record.get("username"):
+                    name_changes[record["username"].casefold()] = key
+        maps[name] = maps[name].updated(changes)
+    if name_changes:
+        usernames = usernames.updated(name_changes)
+    return Snapshot(version, maps["users"], maps["tasks"], maps["events"], usernames)
+
+
+EMPTY = Snapshot(0, PersistentMap(), PersistentMap(), PersistentMap(), PersistentMap())
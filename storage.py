@@ -0,0 +1,747 @@
+"""
+Хранилище состояния бота.
+
+users/tasks/events загружаются с диска один раз при старте и дальше живут
+в памяти вместе с хеш-индексами по id и username. Хендлеры читают и
+меняют записи напрямую, а после изменения помечают нужный файл
+«грязным» через mark_dirty(). На диск изменения уходят пачкой —
+периодическим flush() из JobQueue и при остановке бота.
+
+Где лежат данные, решает бэкенд. JsonBackend пишет файлы атомарно:
+сначала во временный файл рядом, затем os.replace() поверх старого, так
+что после падения на диске всегда лежит либо старая, либо новая версия
+целиком. SqliteBackend хранит по строке на запись и меняет только
+изменённые строки.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+from metrics import STORAGE_BYTES, STORAGE_SECONDS
+from snapshot import EMPTY, next_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class StorageError(Exception):
+    pass
+
+
+class ReservationError(Exception):
+    """Задачу нельзя закрепить: её нет, она уже занята или у участника лимит."""
+
+
+class Moment(NamedTuple):
+    """Разобранное один раз время: epoch-секунды и aware datetime в нужной зоне."""
+    epoch: int
+    dt: datetime
+
+
+def parse_moment(value, tz):
+    """
+    ISO-строку из записи превращает в Moment. Время без зоны считается
+    временем tz, с зоной — переводится в tz. Пусто или мусор — None.
+    """
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    dt = dt.replace(tzinfo=tz) if dt.tzinfo is None else dt.astimezone(tz)
+    return Moment(int(dt.timestamp()), dt)
+
+
+def load_json(path):
+    """
+    Читает JSON-массив. Отсутствующий файл — это пустая коллекция, а вот
+    битый файл — ошибка: молча подменить его пустым списком значит
+    потерять все данные при следующей записи.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+            STORAGE_BYTES.inc("load", amount=os.fstat(f.fileno()).st_size)
+            logger.info("✅ Загружено %d объектов из %s", len(data), path)
+            return data
+    except FileNotFoundError:
+        logger.warning("❌ Файл не найден: %s", path)
+        return []
+    except (OSError, ValueError) as e:
+        raise StorageError(f"Не удалось прочитать {path}: {e}") from e
+
+
+def _write_temp(path, text):
+    """
+    Пишет text (str или bytes) во временный файл рядом с path и сбрасывает
+    его на диск. Возвращает путь к временному файлу и его размер в байтах.
+    """
+    tmp_path = f"{path}.tmp"
+    if isinstance(text, bytes):
+        f = open(tmp_path, 'wb')
+    else:
+        f = open(tmp_path, 'w', encoding='utf-8')
+    with f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+        size = os.fstat(f.fileno()).st_size
+    return tmp_path, size
+
+
+def _fsync_dir(path):
+    # Без этого сам rename может не пережить отключение питания
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_files_atomic(files):
+    """
+    Атомарно заменяет несколько файлов: {путь: текст или bytes}. Все временные файлы
+    пишутся до первой замены, чтобы окно, в котором файлы на диске не
+    согласованы между собой, сводилось к нескольким rename. Возвращает,
+    сколько байт записано.
+    """
+    written = []
+    total = 0
+    try:
+        for path, text in files.items():
+            tmp_path, size = _write_temp(path, text)
+            written.append((tmp_path, path))
+            total += size
+    except OSError:
+        for tmp_path, _ in written:
+            os.remove(tmp_path)
+        raise
+    for tmp_path, path in written:
+        os.replace(tmp_path, path)
+    if written:
+        _fsync_dir(written[0][1])
+    return total
+
+
+# Ключевое поле записи в каждой коллекции
+KEYS = {"users": "user_id", "tasks": "id", "events": "id"}
+
+
+class JsonBackend:
+    """Каждая коллекция — JSON-массив в своём файле, файл переписывается целиком."""
+
+    def __init__(self, users_file, tasks_file, events_file):
+        self.paths = {
+            "users": users_file,
+            "tasks": tasks_file,
+            "events": events_file,
+        }
+
+    def load(self):
+        return {name: load_json(path) for name, path in self.paths.items()}
+
+    def prepare(self, collections, dirty):
+        # JSON не умеет менять одну запись — сериализуем коллекцию целиком
+        return {
+            self.paths[name]: json.dumps(list(collections[name].values()), indent=2, ensure_ascii=False)
+            for name in dirty
+        }
+
+    def write(self, files):
+        return write_files_atomic(files)
+
+
+class SqliteBackend:
+    """
+    Коллекции в SQLite (WAL): одна строка на запись, сама запись хранится
+    JSON-ом в колонке data, а поля, по которым ищем, вынесены в
+    отдельные колонки с индексами. Изменение одной записи — одна строка.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_username ON users (username COLLATE NOCASE);
+
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            project TEXT,
+            type TEXT,
+            reserved_by INTEGER,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tasks_open ON tasks (project, type, reserved_by);
+        CREATE INDEX IF NOT EXISTS tasks_reserved_by ON tasks (reserved_by);
+
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            datetime TEXT,
+            task_id INTEGER,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS events_datetime ON events (datetime);
+        CREATE INDEX IF NOT EXISTS events_task_id ON events (task_id);
+    """
+
+    # Колонки помимо ключа и data: имя колонки -> как достать из записи
+    COLUMNS = {
+        "users": {"username": lambda u: u.get("username")},
+        "tasks": {
+            "project": lambda t: t.get("project"),
+            "type": lambda t: t.get("type"),
+            "reserved_by": lambda t: t.get("reserved_by"),
+        },
+        "events": {
+            "datetime": lambda e: e.get("datetime"),
+            "task_id": lambda e: e.get("task_id"),
+        },
+    }
+
+    def __init__(self, path):
+        self.path = path
+        # Соединением пользуется только flush() (под замком) и загрузка
+        # при старте, поэтому делить его между потоками безопасно.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def load(self):
+        collections = {}
+        for name, key in KEYS.items():
+            rows = self.conn.execute(f"SELECT data FROM {name} ORDER BY {key}")
+            collections[name] = [json.loads(data) for (data,) in rows]
+            logger.info("✅ Загружено %d объектов из %s:%s", len(collections[name]), self.path, name)
+        return collections
+
+    def _row(self, name, record):
+        columns = self.COLUMNS[name]
+        return (
+            record[KEYS[name]],
+            *(get(record) for get in columns.values()),
+            json.dumps(record, ensure_ascii=False),
+        )
+
+    def prepare(self, collections, dirty):
+        """
+        Готовит изменения в потоке событий: (upsert-строки, удалённые ключи)
+        для каждой коллекции. None в dirty означает «переписать всё».
+        """
+        changes = {}
+        for name, ids in dirty.items():
+            records = collections[name]
+            if ids is None:
+                changes[name] = ([self._row(name, r) for r in records.values()], None)
+                continue
+            upserts = [self._row(name, records[i]) for i in ids if i in records]
+            deletes = [(i,) for i in ids if i not in records]
+            changes[name] = (upserts, deletes)
+        return changes
+
+    def write(self, changes):
+        with self.conn:
+            for name, (upserts, deletes) in changes.items():
+                key = KEYS[name]
+                columns = [key, *self.COLUMNS[name], "data"]
+                if deletes is None:
+                    self.conn.execute(f"DELETE FROM {name}")
+                else:
+                    self.conn.executemany(f"DELETE FROM {name} WHERE {key} = ?", deletes)
+                self.conn.executemany(
+                    f"INSERT OR REPLACE INTO {name} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))})",
+                    upserts,
+                )
+
+    def is_empty(self):
+        return not any(
+            self.conn.execute(f"SELECT 1 FROM {name} LIMIT 1").fetchone() for name in KEYS
+        )
+
+
+def import_json(backend, users_file, tasks_file, events_file):
+    """Разовый перенос users/tasks/events из JSON-файлов в другой бэкенд."""
+    collections = JsonBackend(users_file, tasks_file, events_file).load()
+    indexed = {
+        name: {record[KEYS[name]]: record for record in records}
+        for name, records in collections.items()
+    }
+    backend.write(backend.prepare(indexed, {name: None for name in KEYS}))
+    return {name: len(records) for name, records in collections.items()}
+
+
+class Store:
+    def __init__(self, backend, tz=timezone.utc):
+        self.backend = backend
+        # Зона, в которой хранятся даты без явного смещения
+        self.tz = tz
+        # Основное хранение — словари по id (сохраняют порядок вставки,
+        # так что файлы пишутся в том же порядке, что и читались)
+        self._users = {}
+        self._tasks = {}
+        self._events = {}
+        # Вторичные индексы
+        self._users_by_name = {}
+        self._events_by_task = {}
+        # Разобранные даты: id события -> Moment, id задачи -> Moment дедлайна
+        self._event_times = {}
+        self._task_deadlines = {}
+        # Свободные задачи: (проект, тип в нижнем регистре) -> {id: задача}
+        self._open_tasks = {}
+        # Баллы по проектам: сумма положительных баллов и кто их имеет
+        self._project_totals = {}
+        self._project_members = {}
+        self._next_task_id = 1
+        self._next_event_id = 1
+        # Коллекция -> множество изменённых ключей (None — вся коллекция)
+        self._dirty = {}
+        # Последний опубликованный снимок и что поменялось после него,
+        # в том же виде, что _dirty
+        self._snapshot = EMPTY
+        self._stale = dict.fromkeys(KEYS)
+        self._tx_depth = 0
+        self._flush_lock = asyncio.Lock()
+        self._listeners = []
+
+    def load(self):
+        with STORAGE_SECONDS.time("load"):
+            collections = self.backend.load()
+        self._users = {u["user_id"]: u for u in collections["users"]}
+        self._tasks = {t["id"]: t for t in collections["tasks"]}
+        self._events = {e["id"]: e for e in collections["events"]}
+        # Переиндексация может сама поправить записи (старый формат баллов,
+        # устаревшие ставки) — такие правки должны попасть на диск
+        self._dirty.clear()
+        self._reindex()
+        self._stale = dict.fromkeys(KEYS)
+        for kind in ("user", "task", "event"):
+            self._changed(kind, None)
+
+    def _reindex(self):
+        self._users_by_name = {}
+        self._project_totals = {}
+        self._project_members = {}
+        for user in self._users.values():
+            self._index_user(user)
+        self._open_tasks = {}
+        self._task_deadlines = {}
+        for task in self._tasks.values():
+            self._index_task(task)
+            self._index_deadline(task)
+        self._events_by_task = {}
+        self._event_times = {}
+        for event in self._events.values():
+            self._index_event(event)
+        self._next_task_id = max(self._tasks, default=0) + 1
+        self._next_event_id = max(self._events, default=0) + 1
+        # Ставки в файлах могли устареть — пересчитываем один раз при старте
+        self.refresh_percent_rates(*self._project_totals)
+
+    def _index_user(self, user):
+        if user.get("username"):
+            self._users_by_name[user["username"].casefold()] = user
+        # Старый формат: points/percent_rate — просто число, а не словарь
+        # по проектам. Нулевые значения молча переводим в новый формат.
+        for field in ("points", "percent_rate"):
+            if user.get(field) == 0:
+                user[field] = {}
+                self.mark_dirty("users", user["user_id"])
+        if not isinstance(user.get("points", {}), dict):
+            logger.warning("❌ У %s баллы в старом формате: %s", user.get("username"), user["points"])
+            return
+        for project, points in user.get("points", {}).items():
+            if points > 0:
+                self._project_totals[project] = self._project_totals.get(project, 0) + points
+                self._project_members.setdefault(project, set()).add(user["user_id"])
+            else:
+                self._project_totals.setdefault(project, 0)
+
+    @staticmethod
+    def _open_key(task):
+        return task.get("project"), task.get("type", "").lower()
+
+    def _index_task(self, task):
+        if task.get("reserved_by") is None:
+            self._open_tasks.setdefault(self._open_key(task), {})[task["id"]] = task
+
+    def _index_deadline(self, task):
+        moment = parse_moment(task.get("deadline"), self.tz)
+        if moment is None:
+            self._task_deadlines.pop(task["id"], None)
+        else:
+            self._task_deadlines[task["id"]] = moment
+
+    def _unindex_task(self, task):
+        key = self._open_key(task)
+        bucket = self._open_tasks.get(key)
+        if bucket is not None:
+            bucket.pop(task["id"], None)
+            if not bucket:
+                del self._open_tasks[key]
+
+    def _index_event(self, event):
+        moment = parse_moment(event.get("datetime"), self.tz)
+        if moment is None:
+            self._event_times.pop(event["id"], None)
+        else:
+            self._event_times[event["id"]] = moment
+        task_id = event.get("task_id")
+        if task_id is not None:
+            self._events_by_task.setdefault(task_id, {})[event["id"]] = event
+
+    def _unindex_event(self, event):
+        self._event_times.pop(event["id"], None)
+        task_id = event.get("task_id")
+        bucket = self._events_by_task.get(task_id)
+        if bucket is not None:
+            bucket.pop(event["id"], None)
+            if not bucket:
+                del self._events_by_task[task_id]
+
+    def subscribe(self, callback):
+        """
+        callback(kind, entity_id) вызывается после добавления, изменения
+        или удаления участника (kind="user"), задачи (kind="task") или
+        события (kind="event"). После load() приходит (kind, None) для
+        каждого вида — все записи могли поменяться.
+        """
+        self._listeners.append(callback)
+
+    def _changed(self, kind, entity_id):
+        for callback in self._listeners:
+            callback(kind, entity_id)
+
+    def mark_dirty(self, name, *ids):
+        """
+        Помечает изменённые записи коллекции name по их ключам. Без ids
+        коллекция помечается изменённой целиком.
+        """
+        if name not in KEYS:
+            raise KeyError(f"Неизвестная коллекция: {name}")
+        for marks in (self._dirty, self._stale):
+            if not ids:
+                marks[name] = None
+            elif name not in marks:
+                marks[name] = set(ids)
+            elif marks[name] is not None:
+                marks[name].update(ids)
+
+    def snapshot(self):
+        """
+        Текущий неизменяемый снимок (snapshot.Snapshot) для хендлеров,
+        которые только читают. Новая версия собирается при первом чтении
+        после изменений и копирует только изменившиеся записи.
+        """
+        if self._stale:
+            stale, self._stale = self._stale, {}
+            live = {"users": self._users, "tasks": self._tasks, "events": self._events}
+            moments = {"tasks": self._task_deadlines.get, "events": self._event_times.get}
+            self._snapshot = next_snapshot(self._snapshot, self._snapshot.version + 1, live, stale, moments)
+        return self._snapshot
+
+    # --- Чтение ---
+    # Коллекции отдаются как представления словарей. Если между шагами
+    # итерации есть await, оборачивайте в list(), иначе параллельная
+    # мутация сломает цикл.
+
+    @property
+    def users(self):
+        return self._users.values()
+
+    @property
+    def tasks(self):
+        return self._tasks.values()
+
+    @property
+    def events(self):
+        return self._events.values()
+
+    def get_user(self, user_id):
+        return self._users.get(user_id)
+
+    def find_user(self, username):
+        """Ищет участника по username без учёта регистра и ведущего @."""
+        return self._users_by_name.get(username.lstrip("@").casefold())
+
+    def get_task(self, task_id):
+        return self._tasks.get(task_id)
+
+    def get_event(self, event_id):
+        return self._events.get(event_id)
+
+    def event_time(self, event_id):
+        """Moment события или None, если дата не задана или не разбирается."""
+        return self._event_times.get(event_id)
+
+    def task_deadline(self, task_id):
+        """Moment дедлайна задачи или None, если дедлайна нет."""
+        return self._task_deadlines.get(task_id)
+
+    def task_events(self, task_id):
+        return list(self._events_by_task.get(task_id, {}).values())
+
+    def open_tasks(self, project, types):
+        """Свободные задачи проекта с типом из types (в нижнем регистре), по возрастанию id."""
+        found = []
+        for task_type in set(types):
+            found.extend(self._open_tasks.get((project, task_type), {}).values())
+        found.sort(key=lambda t: t["id"])
+        return found
+
+    # --- Мутации, которые меняют сами коллекции, а не отдельные записи ---
+    # Поля, по которым строятся индексы (user_id, username, id, task_id),
+    # после добавления записи не меняются.
+
+    def next_task_id(self):
+        return self._next_task_id
+
+    def next_event_id(self):
+        return self._next_event_id
+
+    def add_task(self, task):
+        self._tasks[task["id"]] = task
+        self._index_task(task)
+        self._index_deadline(task)
+        self._next_task_id = max(self._next_task_id, task["id"] + 1)
+        self.mark_dirty("tasks", task["id"])
+        self._changed("task", task["id"])
+
+    def add_points(self, user_id, project, amount):
+        """
+        Начисляет (или списывает) баллы участнику в проекте. Ставки не
+        пересчитывает — после пачки начислений вызовите refresh_percent_rates().
+        """
+        user = self._users[user_id]
+        points = user.setdefault("points", {})
+        old = points.get(project, 0)
+        new = old + amount
+        points[project] = new
+
+        total = self._project_totals.get(project, 0) - max(old, 0) + max(new, 0)
+        self._project_totals[project] = total
+        members = self._project_members.setdefault(project, set())
+        if new > 0:
+            members.add(user_id)
+        else:
+            members.discard(user_id)
+            user.setdefault("percent_rate", {})[project] = 0.0
+        self.mark_dirty("users", user_id)
+        return user
+
+    def add_points_bulk(self, grants):
+        """
+        Применяет пачку начислений [(user_id, проект, баллы), ...] одним
+        коммитом и пересчитывает ставки по разу на каждый затронутый проект.
+        Проверять grants нужно заранее: неизвестный user_id — KeyError.
+        """
+        with self.transaction():
+            for user_id, project, amount in grants:
+                self.add_points(user_id, project, amount)
+            self.refresh_percent_rates(*{project for _, project, _ in grants})
+
+    def refresh_percent_rates(self, *projects):
+        """
+        Пересчитывает долю баллов участников в указанных проектах. Трогает
+        только тех, у кого в проекте есть баллы, и пишет только изменившиеся.
+        """
+        for project in projects:
+            total = self._project_totals.get(project, 0)
+            for user_id in self._project_members.get(project, ()):
+                user = self._users[user_id]
+                rate = round(user["points"][project] / total, 3) if total else 0.0  # Округляем до тысячных
+                rates = user.setdefault("percent_rate", {})
+                if rates.get(project) != rate:
+                    rates[project] = rate
+                    self.mark_dirty("users", user_id)
+
+    def update_task(self, task_id, **fields):
+        """Меняет поля задачи, кроме id и reserved_by (для них — reserve/release)."""
+        task = self._tasks[task_id]
+        reindex = "project" in fields or "type" in fields
+        if reindex:
+            self._unindex_task(task)
+        task.update(fields)
+        if reindex:
+            self._index_task(task)
+        if "deadline" in fields:
+            self._index_deadline(task)
+        self.mark_dirty("tasks", task_id)
+        self._changed("task", task_id)
+        return task
+
+    def remove_task(self, task_id):
+        """Удаляет задачу и снимает её с исполнителя. Возвращает удалённую задачу."""
+        task = self._tasks.pop(task_id, None)
+        if task is None:
+            return None
+        self._unindex_task(task)
+        self._task_deadlines.pop(task_id, None)
+        self._drop_reservation(task)
+        self.mark_dirty("tasks", task_id)
+        self._changed("task", task_id)
+        return task
+
+    def reserve_task(self, task_id, user_id, deadline=None):
+        """
+        Закрепляет задачу за участником. deadline (ISO-строка) ставится,
+        только если у задачи ещё нет своего дедлайна.
+        """
+        task = self._tasks[task_id]
+        self._unindex_task(task)
+        task["reserved_by"] = user_id
+        if not task.get("deadline"):
+            task["deadline"] = deadline
+            self._index_deadline(task)
+        user = self._users.get(user_id)
+        if user is not None:
+            user.setdefault("reserved_tasks", []).append(task_id)
+            self.mark_dirty("users", user_id)
+        self.mark_dirty("tasks", task_id)
+        self._changed("task", task_id)
+        return task
+
+    def try_reserve(self, task_id, user_id, deadline=None, limit=None):
+        """
+        Compare-and-set для reserve_task: закрепляет задачу, только если она
+        существует, ещё свободна и у участника меньше limit задач. Иначе
+        бросает ReservationError, ничего не меняя.
+        """
+        task = self._tasks.get(task_id)
+        if task is None:
+            raise ReservationError(f"Задача #{task_id} не найдена.")
+        if task.get("reserved_by") is not None:
+            raise ReservationError(f"Задача #{task_id} уже занята.")
+        user = self._users.get(user_id)
+        if limit is not None and user is not None and len(user.get("reserved_tasks", [])) >= limit:
+            raise ReservationError(f"Нельзя иметь более {limit} задач одновременно.")
+        return self.reserve_task(task_id, user_id, deadline)
+
+    def release_task(self, task_id, expected_user=None):
+        """
+        Снимает задачу с исполнителя и обнуляет дедлайн — задача снова
+        становится доступной. Возвращает id бывшего исполнителя.
+        С expected_user задача снимается, только если её держит именно он
+        (иначе None) — так истёкший дедлайн не отберёт задачу у нового
+        исполнителя.
+        """
+        task = self._tasks.get(task_id)
+        if task is None:
+            return None
+        reserved_by = task.get("reserved_by")
+        if expected_user is not None and reserved_by != expected_user:
+            return None
+        self._drop_reservation(task)
+        task["reserved_by"] = None
+        task["deadline"] = None
+        self._index_task(task)
+        self._task_deadlines.pop(task_id, None)
+        self.mark_dirty("tasks", task_id)
+        self._changed("task", task_id)
+        return reserved_by
+
+    def _drop_reservation(self, task):
+        user = self._users.get(task.get("reserved_by"))
+        if user is not None and task["id"] in user.get("reserved_tasks", []):
+            user["reserved_tasks"].remove(task["id"])
+            self.mark_dirty("users", user["user_id"])
+
+    def add_event(self, event):
+        self._events[event["id"]] = event
+        self._index_event(event)
+        self._next_event_id = max(self._next_event_id, event["id"] + 1)
+        self.mark_dirty("events", event["id"])
+        self._changed("event", event["id"])
+
+    def update_event(self, event_id, **fields):
+        event = self._events[event_id]
+        event.update(fields)
+        if "datetime" in fields:
+            self._index_event(event)
+        self.mark_dirty("events", event_id)
+        self._changed("event", event_id)
+        return event
+
+    def remove_event(self, event_id):
+        event = self._events.pop(event_id, None)
+        if event is not None:
+            self._unindex_event(event)
+            self.mark_dirty("events", event_id)
+            self._changed("event", event_id)
+
+    def remove_task_events(self, task_id):
+        """Удаляет все события, привязанные к задаче. Возвращает их количество."""
+        bucket = self._events_by_task.pop(task_id, {})
+        for event_id in bucket:
+            del self._events[event_id]
+            self._event_times.pop(event_id, None)
+        if bucket:
+            self.mark_dirty("events", *bucket)
+        for event_id in bucket:
+            self._changed("event", event_id)
+        return len(bucket)
+
+    # --- Запись на диск ---
+
+    @contextmanager
+    def transaction(self):
+        """
+        Группирует связанные изменения нескольких коллекций: пока блок не
+        завершён, flush() ничего не пишет, поэтому на диск попадает либо
+        всё, либо ничего. Нужен там, где между изменениями есть await.
+        """
+        self._tx_depth += 1
+        try:
+            yield self
+        finally:
+            self._tx_depth -= 1
+
+    async def flush(self):
+        """
+        Сбрасывает на диск все изменённые с прошлого раза коллекции одним
+        коммитом. Все изменения, накопившиеся между вызовами, пишутся
+        одной записью на файл.
+        """
+        async with self._flush_lock:
+            if not self._dirty or self._tx_depth:
+                return
+            dirty, self._dirty = self._dirty, {}
+            # Сериализуем здесь, в потоке событий, чтобы хендлеры не
+            # поменяли данные, пока они пишутся в фоне.
+            collections = {"users": self._users, "tasks": self._tasks, "events": self._events}
+            started = time.perf_counter()
+            payload = self.backend.prepare(collections, dirty)
+            try:
+                written = await asyncio.to_thread(self.backend.write, payload)
+            except (OSError, sqlite3.Error) as e:
+                # Вернём изменения в очередь — попробуем в следующий раз
+                for name, ids in dirty.items():
+                    self.mark_dirty(name, *(ids or ()))
+                logger.error("❌ Ошибка при сохранении %s: %s", ", ".join(sorted(dirty)), e)
+                return
+            STORAGE_SECONDS.observe(time.perf_counter() - started, "save")
+            if written:
+                STORAGE_BYTES.inc("save", amount=written)
+            logger.debug("💾 Сохранено: %s", ", ".join(sorted(dirty)))
+
+
+if __name__ == "__main__":
+    # Разовая миграция: python storage.py bot.db users.json tasks.json events.json
+    if len(sys.argv) != 5:
+        sys.exit("Использование: python storage.py <db> <users.json> <tasks.json> <events.json>")
+    db = SqliteBackend(sys.argv[1])
+    if not db.is_empty():
+        sys.exit(f"❌ В {sys.argv[1]} уже есть данные, импорт отменён")
+    counts = import_json(db, *sys.argv[2:])
+    print(f"✅ Импортировано: {counts}")
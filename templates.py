@@ -0,0 +1,262 @@
+"""
+HTML-карточки задач и событий для списков и кэш их отрисовки.
+
+Карточки рендерятся из записей снимка Store (snapshot.py) — один раз
+на версию записи — и хранятся в кэше по (вид, id). Даты берутся из
+уже разобранного поля MOMENT записи, а не из живых индексов Store,
+поэтому карточка показывает ту же версию, что и список вокруг неё.
+Store через subscribe() сбрасывает карточки ровно той задачи или
+события, которые изменились. Список — это join готовых фрагментов.
+Всё, что зависит от текущего момента (прошло событие или нет),
+в кэш не попадает и подставляется при сборке.
+"""
+import html
+import re
+from datetime import datetime
+
+from snapshot import MOMENT, VERSION
+
+# Лимит Telegram на длину одного сообщения
+MAX_MESSAGE_LEN = 4096
+
+month_names = {
+    1: "января", 2: "февраля", 3: "марта", 4: "апреля", 5: "мая", 6: "июня",
+    7: "июля", 8: "августа", 9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"
+}
+
+
+def format_datetime_rus(dt: datetime) -> str:
+    return f"{dt.day} {month_names[dt.month]} в {dt.strftime('%H:%M')}"
+
+
+def format_estimate(estimated_days) -> str:
+    """Оценка задачи в днях -> «2 нед. 3 дн.», «1 нед.» или «5 дн.»."""
+    if estimated_days < 7:
+        return f"{estimated_days} дн."
+    weeks, days = divmod(estimated_days, 7)
+    if days == 0:
+        return f"{weeks} нед."
+    return f"{weeks} нед. {days} дн."
+
+
+def _esc(value) -> str:
+    return html.escape(str(value), quote=False)
+
+
+class CardCache:
+    def __init__(self, store):
+        self.store = store
+        # (вид, id) -> (запись снимка, {шаблон: готовый HTML})
+        self._cards = {}
+        self.hits = 0
+        self.misses = 0
+        store.subscribe(self._on_change)
+
+    def _on_change(self, kind, entity_id):
+        if kind not in ("task", "event"):
+            return
+        if entity_id is None:
+            self._cards.clear()
+        else:
+            self._cards.pop((kind, entity_id), None)
+
+    def _get(self, kind, entity, template, render):
+        key = (kind, entity["id"])
+        source, cards = self._cards.get(key, (None, None))
+        if source is not entity:
+            # Неизменённые записи разные версии снимка делят, так что другой
+            # объект — это другая версия. Более старую (снимок взят до
+            # правки) рендерим мимо кэша, чтобы не вытеснить текущую.
+            if source is not None and entity[VERSION] < source[VERSION]:
+                self.misses += 1
+                return render(entity)
+            cards = {}
+            self._cards[key] = (entity, cards)
+        card = cards.get(template)
+        if card is None:
+            self.misses += 1
+            card = cards[template] = render(entity)
+        else:
+            self.hits += 1
+        return card
+
+    # --- Задачи ---
+
+    def task(self, task, template="offer"):
+        """
+        offer — свободная задача (для /get_task), mine — задача участника
+        с дедлайном (/my_task), admin — со статусом резерва (/search_task).
+        """
+        return self._get("task", task, template, getattr(self, f"_task_{template}"))
+
+    @staticmethod
+    def _task_head(task):
+        return (f"🔹 <b>{_esc(task['title'])}</b> (#{task['id']})\n"
+                f"📄 {_esc(task['description'])}\n"
+                f"📂 Тип: {_esc(task['type'])}\n"
+                f"🏆 Баллы: {task['points']}\n")
+
+    def _task_offer(self, task):
+        return (self._task_head(task)
+                + f"⏰ Примерное время: {format_estimate(task.get('estimated_days', 7))}\n\n")
+
+    def _task_mine(self, task):
+        deadline = task[MOMENT]
+        date_str = format_datetime_rus(deadline.dt) if deadline else "Не назначен"
+        return self._task_head(task) + f"⏰ Дедлайн: {date_str}\n\n"
+
+    def _task_admin(self, task):
+        reserved_by = task.get("reserved_by")
+        reserved_str = f"Зарезервирована пользователем {reserved_by}" if reserved_by else "Свободна"
+        return (self._task_head(task)
+                + f"⏰ Примерное время: {format_estimate(task.get('estimated_days', 7))}\n"
+                + f"📌 Статус: {reserved_str}\n\n")
+
+    # --- События ---
+
+    def _event_when(self, event):
+        moment = event[MOMENT]
+        return format_datetime_rus(moment.dt) if moment else _esc(event.get("datetime"))
+
+    def event(self, event):
+        """Карточка для /upcoming_events."""
+        return self._get("event", event, "upcoming", self._event_upcoming)
+
+    def event_admin(self, event, now):
+        """Карточка для /show_all_events; статус считается относительно now."""
+        head, tail = self._get("event", event, "admin", self._event_admin)
+        moment = event[MOMENT]
+        status = "✅ Актуально" if moment and moment.dt >= now else "⌛ Уже прошло"
+        return f"{head}📌 Статус: {status}\n{tail}"
+
+    def _event_upcoming(self, event):
+        return (f"📢 <b>{_esc(event['title'])}</b>\n"
+                f"🕒 {self._event_when(event)}\n"
+                f"{_esc(event['description'])}\n\n")
+
+    def _event_admin(self, event):
+        personal_str = " (Персональное)" if event.get("personal", False) else ""
+        head = (f"🔹 <b>{_esc(event['title'])}</b>{personal_str}\n"
+                f"🗂️ Тип: {_esc(event['type'])}\n"
+                f"🕒 Когда: {self._event_when(event)}\n"
+                f"📄 {_esc(event['description'])}\n")
+        return head, f"🆔 ID: {event['id']}\n\n"
+
+
+def render_list(title, cards):
+    """Заголовок и готовые карточки одной строкой."""
+    return title + "".join(cards)
+
+
+# Тег, HTML-сущность или кусок обычного текста
+_TOKEN = re.compile(r"<[^>]*>|&#?\w+;|[^<&]+|[<&]")
+_TAG = re.compile(r"<(/?)(\w+)")
+
+
+def message_len(text) -> int:
+    """Длина текста так, как её считает Telegram — в UTF-16 (эмодзи — две единицы)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+# Неразрывная единица при разрезании карточки: тег, слово (вместе
+# с сущностями внутри и пробелами после) или пробелы
+_UNIT = re.compile(r"<[^>]*>|[^<\s]+\s*|\s+|<")
+_EMPTY_TAG = re.compile(r"<(\w+)[^>]*></\1>")
+
+
+def _cut_word(word, room):
+    """
+    Сколько первых символов слова, которое длиннее целого сообщения,
+    влезает в room единиц UTF-16 — не разрывая сущности.
+    """
+    n = 0
+    for piece in _TOKEN.findall(word):
+        left = room - message_len(word[:n])
+        if message_len(piece) <= left:
+            n += len(piece)
+            continue
+        if not piece.startswith("&"):
+            k = min(len(piece), left)
+            while k and message_len(piece[:k]) > left:
+                k -= 1
+            n += k
+        break
+    return n
+
+
+def _split_card(card, limit):
+    """
+    Режет одну слишком длинную карточку на части не длиннее limit по
+    границам слов и строк. Теги и сущности не разрываются: открытые на
+    границе теги закрываются в конце части и открываются заново в начале
+    следующей. Слово режется, только если оно одно длиннее сообщения.
+    """
+    part, size, open_tags = [], 0, []
+
+    def closing():
+        return "".join(f"</{name}>" for name, _ in reversed(open_tags))
+
+    def reopened():
+        return sum(message_len(tag) for _, tag in open_tags)
+
+    def flush():
+        nonlocal part, size
+        # Тег, открытый прямо перед границей, остался бы пустым — его откроем в следующей части
+        text = _EMPTY_TAG.sub("", "".join(part) + closing())
+        part = [tag for _, tag in open_tags]
+        size = reopened()
+        return text
+
+    for unit in _UNIT.findall(card):
+        tag = _TAG.match(unit) if unit.startswith("<") else None
+        reserve = message_len(closing())
+        if tag and not tag.group(1):
+            # Вместе с открывающим тегом придётся зарезервировать и закрывающий
+            reserve += len(tag.group(2)) + 3
+        if size + message_len(unit) + reserve > limit and size > reopened():
+            yield flush()
+        while size + message_len(unit) + reserve > limit:
+            # Не влезает даже в пустую часть: рвём слово, тег — никогда
+            cut = 0 if tag else _cut_word(unit, limit - size - reserve)
+            if not cut:
+                raise ValueError("Фрагмент HTML длиннее лимита сообщения")
+            part.append(unit[:cut])
+            unit = unit[cut:]
+            yield flush()
+        part.append(unit)
+        size += message_len(unit)
+        if tag:
+            if tag.group(1):
+                if open_tags and open_tags[-1][0] == tag.group(2):
+                    open_tags.pop()
+            else:
+                open_tags.append((tag.group(2), unit))
+    if part:
+        yield "".join(part)
+
+
+def chunk_cards(title, cards, limit=MAX_MESSAGE_LEN):
+    """
+    Собирает заголовок и карточки в сообщения не длиннее limit. Режет
+    только по границам карточек (теги в карточках всегда закрыты), и лишь
+    карточку, которая сама не влезает в сообщение, — по строкам и словам.
+    """
+    part, size = [title], message_len(title)
+    for card in cards:
+        card_size = message_len(card)
+        if size + card_size > limit and part == [title]:
+            # Заголовок не уходит отдельным сообщением: режем его вместе с карточкой
+            card, card_size = title + card, size + card_size
+            part, size = [], 0
+        elif size + card_size > limit and size:
+            yield "".join(part).strip()
+            part, size = [], 0
+        if card_size > limit:
+            *pieces, card = _split_card(card, limit)
+            for piece in pieces:
+                yield piece.strip()
+            card_size = message_len(card)
+        part.append(card)
+        size += card_size
+    if size:
+        yield "".join(part).strip()
@@ -0,0 +1,74 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+from telegram.ext import ApplicationBuilder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import DUE, EventScheduler  # noqa: E402
+from storage import JsonBackend, Store  # noqa: E402
+
+TZ = timezone.utc
+
+
+def make_store(tmp_path, events):
+    paths = [tmp_path / f"{name}.json" for name in ("users", "tasks", "events")]
+    for path in paths:
+        path.write_text("[]", encoding="utf-8")
+    store = Store(JsonBackend(*map(str, paths)), tz=TZ)
+    store.load()
+    for event in events:
+        store.add_event(event)
+    return store
+
+
+def event(event_id, at):
+    return {
+        "id": event_id,
+        "type": "meeting",
+        "title": f"Событие {event_id}",
+        "datetime": at.isoformat(),
+        "notify_users": True,
+        "notified_24h": True,
+        "notified_2h": True,
+    }
+
+
+def run_scheduler(store, seconds):
+    fired = []
+
+    async def fire(context, event, kind):
+        fired.append((event["id"], kind))
+
+    async def main():
+        app = ApplicationBuilder().token("123:TEST").build()
+        scheduler = EventScheduler(store, fire, TZ)
+        await app.job_queue.start()
+        try:
+            scheduler.start(app.job_queue)
+            await asyncio.sleep(seconds)
+        finally:
+            await app.job_queue.stop()
+
+    asyncio.run(main())
+    return fired
+
+
+def test_overdue_event_fires_and_later_ones_still_fire(tmp_path):
+    now = datetime.now(TZ)
+    store = make_store(tmp_path, [
+        event(1, now - timedelta(minutes=10)),
+        event(2, now + timedelta(seconds=2)),
+    ])
+
+    fired = run_scheduler(store, 3.5)
+
+    assert fired == [(1, DUE), (2, DUE)]
+
+
+def test_long_overdue_event_is_not_dropped_as_missed(tmp_path):
+    store = make_store(tmp_path, [event(1, datetime.now(TZ) - timedelta(days=473))])
+
+    assert run_scheduler(store, 1) == [(1, DUE)]
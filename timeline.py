@@ -0,0 +1,94 @@
+"""
+Индекс событий по времени для /upcoming_events.
+
+Общие события лежат в одном отсортированном списке (время, id), а
+персональные — в отдельном списке у каждого участника. «Ближайшие N
+событий участника» — это bisect по обоим спискам и слияние. Прошедшие
+записи не чистим заранее: их отрезает первый же запрос, которому они
+попались, поэтому стоимость запроса не растёт с историей событий.
+"""
+import heapq
+from bisect import bisect_left, insort
+from datetime import datetime
+from itertools import islice
+
+
+class EventTimeline:
+    def __init__(self, store):
+        self.store = store
+        # Общие события: [(timestamp, id)], по возрастанию
+        self._public = []
+        # user_id -> [(timestamp, id)] персональных событий участника
+        self._personal = {}
+        # id события -> (timestamp, в каких списках лежит)
+        self._entries = {}
+        self._built = False
+        store.subscribe(self._on_change)
+
+    def _on_change(self, kind, entity_id):
+        if kind != "event":
+            return
+        if entity_id is None:
+            self._built = False
+        elif self._built:
+            self._remove(entity_id)
+            event = self.store.get_event(entity_id)
+            if event is not None:
+                self._add(event)
+
+    def _build(self):
+        self._public = []
+        self._personal = {}
+        self._entries = {}
+        for event in self.store.events:
+            self._add(event)
+        self._built = True
+
+    def _add(self, event):
+        moment = self.store.event_time(event["id"])
+        if moment is None:
+            return
+        ts = moment.epoch
+        entry = (ts, event["id"])
+        if event.get("personal", False):
+            lists = [self._personal.setdefault(user_id, []) for user_id in set(event.get("users", []))]
+        else:
+            lists = [self._public]
+        for timeline in lists:
+            insort(timeline, entry)
+        self._entries[event["id"]] = (ts, lists)
+
+    def _remove(self, event_id):
+        ts, lists = self._entries.pop(event_id, (None, ()))
+        for timeline in lists:
+            i = bisect_left(timeline, (ts, event_id))
+            # Запись могла уже уйти при обрезке прошедших
+            if i < len(timeline) and timeline[i] == (ts, event_id):
+                del timeline[i]
+
+    @staticmethod
+    def _prune(timeline, now):
+        """Отрезает прошедшие записи из начала списка."""
+        i = bisect_left(timeline, (now,))
+        if i:
+            del timeline[:i]
+
+    def upcoming(self, user_id, now: datetime, limit=5):
+        """
+        Ближайшие limit событий, которые видит участник: общие и его
+        персональные, начиная с now, по возрастанию времени.
+        """
+        return [self.store.get_event(event_id)
+                for event_id in self.upcoming_ids(user_id, now, limit)]
+
+    def upcoming_ids(self, user_id, now: datetime, limit=5):
+        """То же, что upcoming(), но id событий — чтобы взять записи из снимка."""
+        if not self._built:
+            self._build()
+        now = now.timestamp()
+        timelines = [self._public]
+        if user_id in self._personal:
+            timelines.append(self._personal[user_id])
+        for timeline in timelines:
+            self._prune(timeline, now)
+        return [event_id for _, event_id in islice(heapq.merge(*timelines), limit)]